@@ -2,17 +2,40 @@ import base64
 import os
 import json
 import random
+import threading
 import uuid
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import boto3
 from botocore.config import Config
-from botocore.exceptions import EndpointConnectionError, ClientError
+from botocore.exceptions import BotoCoreError, EndpointConnectionError, ClientError
 
 
 SQS_ENDPOINT_URL = os.environ.get("SQS_ENDPOINT_URL", "http://localstack:4566")
 FLEET_SIZE = int(os.environ.get("FLEET_SIZE", 10))
+INVALID_PROBABILITY = float(os.environ.get("INVALID_PROBABILITY", 0.01))
+# "fleet" sends a submission per device every 30-45 seconds,
+# "load" sends submissions at LOAD_RATE per second
+MODE = os.environ.get("MODE", "fleet")
+LOAD_RATE = float(os.environ.get("LOAD_RATE", 100))
+# seconds, 0 runs until stopped
+LOAD_DURATION = float(os.environ.get("LOAD_DURATION", 0))
+LOAD_DEVICES = int(os.environ.get("LOAD_DEVICES", 5000))
+# concurrent SendMessageBatch requests
+LOAD_CONCURRENCY = int(os.environ.get("LOAD_CONCURRENCY", 16))
+# events of each type in a submission
+EVENT_COUNT_DISTRIBUTION = os.environ.get("EVENT_COUNT_DISTRIBUTION", "uniform:3:5")
+# the size of a submission JSON in bytes, 0 keeps the generated size
+PAYLOAD_SIZE_DISTRIBUTION = os.environ.get("PAYLOAD_SIZE_DISTRIBUTION", "fixed:0")
+REPORT_INTERVAL = float(os.environ.get("REPORT_INTERVAL", 10))
+
+# the limits of SendMessageBatch
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+# a base64 encoded submission must fit into a message
+MAX_PAYLOAD_SIZE = MAX_BATCH_BYTES * 3 // 4 - 1024
 
 COMMANDS = [
     "whoami",
@@ -58,27 +81,178 @@ def generate_new_process_event(invalid_probability=0.01):
     }
 
 
-def generate_submission(device_id, invalid_probability=0.01):
+def parse_distribution(spec):
+    """
+    Returns a function sampling non-negative integers from a distribution:
+    "fixed:N", "uniform:MIN:MAX", "normal:MEAN:STDDEV" or "lognormal:MU:SIGMA"
+    """
+    name, *params = spec.split(":")
+    params = [float(param) for param in params]
+    samplers = {
+        "fixed": (1, lambda value: value),
+        "uniform": (2, random.uniform),
+        "normal": (2, random.gauss),
+        "lognormal": (2, random.lognormvariate),
+    }
+    if name not in samplers or len(params) != samplers[name][0]:
+        raise ValueError(f"Unknown distribution: {spec}")
+    sample = samplers[name][1]
+    return lambda: max(0, round(sample(*params)))
+
+
+def pad_submission(submission, payload_size):
+    """
+    Appends arguments to command lines until the submission JSON has about `payload_size` bytes
+    """
+    padding = min(payload_size, MAX_PAYLOAD_SIZE) - len(json.dumps(submission))
+    events = [event for event in submission["events"]["new_process"] if event["cmdl"] is not None]
+    if padding <= 0 or not events:
+        return submission
+    per_event = padding // len(events)
+    for event in events:
+        event["cmdl"] += " " + "x" * max(0, per_event - 1)
+    return submission
+
+
+def generate_submission(device_id, invalid_probability=0.01, get_event_count=None, payload_size=0):
     """
     Generates a sensor submission with some probability for invalid data
     """
-    return {
+    get_event_count = get_event_count or (lambda: random.randint(3, 5))
+    submission = {
         "submission_id": str(uuid.uuid4()) if random.uniform(0, 1) > invalid_probability else 'not-an-uuid',
         "device_id": device_id if random.uniform(0, 1) > invalid_probability else 'not-an-uuid',
         "time_created": datetime.now().isoformat(),
         "events": {
-            "new_process": [generate_new_process_event() for _ in range(random.randint(3, 5))],
-            "network_connection": [generate_network_event() for _ in range(random.randint(3, 5))]
+            "new_process": [
+                generate_new_process_event(invalid_probability) for _ in range(get_event_count())
+            ],
+            "network_connection": [
+                generate_network_event(invalid_probability) for _ in range(get_event_count())
+            ]
         }
     }
+    return pad_submission(submission, payload_size) if payload_size else submission
+
+
+def encode_submission(submission):
+    return base64.b64encode(json.dumps(submission).encode()).decode()
 
 
 def send_submissions(sqs_client, submissions):
     queue_url = sqs_client.get_queue_url(QueueName='submissions')['QueueUrl']
     for submission in submissions:
-        encoded_submission = json.dumps(submission).encode()
-        message = base64.b64encode(encoded_submission).decode()
-        sqs_client.send_message(QueueUrl=queue_url, MessageBody=message)
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=encode_submission(submission))
+
+
+def send_message_batch(sqs_client, queue_url, messages):
+    """
+    Sends up to 10 messages, returns the numbers of sent and failed messages
+    """
+    try:
+        response = sqs_client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{"Id": str(i), "MessageBody": message} for i, message in enumerate(messages)]
+        )
+    except (BotoCoreError, ClientError):
+        return 0, len(messages)
+    failed = len(response.get("Failed", []))
+    return len(messages) - failed, failed
+
+
+def split_into_batches(messages):
+    batch, batch_size = [], 0
+    for message in messages:
+        if batch and (len(batch) == MAX_BATCH_ENTRIES or batch_size + len(message) > MAX_BATCH_BYTES):
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(message)
+        batch_size += len(message)
+    if batch:
+        yield batch
+
+
+class LoadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.requests = 0
+        self.reported_at = self.started_at
+        self.reported_sent = 0
+
+    def add(self, sent, failed):
+        with self.lock:
+            self.sent += sent
+            self.failed += failed
+            self.requests += 1
+
+    def report(self, final=False):
+        now = time.monotonic()
+        with self.lock:
+            sent, failed, requests = self.sent, self.failed, self.requests
+        if final:
+            elapsed, interval_sent = now - self.started_at, sent
+        else:
+            elapsed, interval_sent = now - self.reported_at, sent - self.reported_sent
+        self.reported_at, self.reported_sent = now, sent
+        label = "Total" if final else f"Last {elapsed:.0f}s"
+        print(
+            f"{label}: {interval_sent / max(elapsed, 1e-9):.1f} submissions/s (target {LOAD_RATE:g}), "
+            f"sent {sent}, failed {failed}, requests {requests}",
+            flush=True
+        )
+
+
+def generate_load(sqs_client):
+    """
+    Sends submissions of LOAD_DEVICES devices at LOAD_RATE per second with
+    LOAD_CONCURRENCY concurrent SendMessageBatch requests. When the requests
+    can not keep up, the achieved rate is lower than the target one.
+    """
+    queue_url = sqs_client.get_queue_url(QueueName='submissions')['QueueUrl']
+    device_ids = [str(uuid.uuid4()) for _ in range(LOAD_DEVICES)]
+    get_event_count = parse_distribution(EVENT_COUNT_DISTRIBUTION)
+    get_payload_size = parse_distribution(PAYLOAD_SIZE_DISTRIBUTION)
+    stats = LoadStats()
+    in_flight = threading.BoundedSemaphore(LOAD_CONCURRENCY * 2)
+
+    def on_sent(future):
+        try:
+            stats.add(*future.result())
+        finally:
+            in_flight.release()
+
+    # submissions are generated in groups of up to 10 per tick
+    group_size = max(1, min(MAX_BATCH_ENTRIES, round(LOAD_RATE / 100)))
+    tick = group_size / LOAD_RATE
+    print(f"Generating {LOAD_RATE:g} submissions/s of {LOAD_DEVICES} devices", flush=True)
+    with ThreadPoolExecutor(LOAD_CONCURRENCY) as executor:
+        next_at = stats.started_at
+        try:
+            while not LOAD_DURATION or time.monotonic() - stats.started_at < LOAD_DURATION:
+                now = time.monotonic()
+                if next_at > now:
+                    time.sleep(next_at - now)
+                elif now - next_at > 1:
+                    # do not send the missed submissions in a burst
+                    next_at = now
+                next_at += tick
+                messages = [
+                    encode_submission(generate_submission(
+                        random.choice(device_ids), INVALID_PROBABILITY, get_event_count, get_payload_size()
+                    ))
+                    for _ in range(group_size)
+                ]
+                for batch in split_into_batches(messages):
+                    in_flight.acquire()
+                    executor.submit(send_message_batch, sqs_client, queue_url, batch).add_done_callback(on_sent)
+                if now - stats.reported_at >= REPORT_INTERVAL:
+                    stats.report()
+        except KeyboardInterrupt:
+            pass
+    stats.report(final=True)
 
 
 def main():
@@ -88,14 +262,20 @@ def main():
         retries = {
             'max_attempts': 3,
             'mode': 'standard'
-        }
+        },
+        max_pool_connections=max(10, LOAD_CONCURRENCY)
     )
     sqs_client = boto3.client('sqs', config=config, endpoint_url=SQS_ENDPOINT_URL, verify=False)
+    if MODE == "load":
+        generate_load(sqs_client)
+        return
     # use fixed number of sensors in the fleet
     device_ids = [str(uuid.uuid4()) for _ in range(FLEET_SIZE)]
     while True:
         print("Sending submissions...")
-        submissions = [generate_submission(device_id) for device_id in device_ids]
+        submissions = [
+            generate_submission(device_id, INVALID_PROBABILITY) for device_id in device_ids
+        ]
         try:
             send_submissions(sqs_client, submissions)
         except (EndpointConnectionError, ClientError):
@@ -0,0 +1,78 @@
+"""partition submissions by created_at
+
+Revision ID: 5b1d9e0f2a7c
+Revises: c7ae6a3d004a
+Create Date: 2026-10-18 12:41:07.318204
+
+"""
+from datetime import UTC, datetime, timedelta
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import CheckConstraint
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1d9e0f2a7c'
+down_revision: Union[str, None] = 'c7ae6a3d004a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# the worker creates the next partitions, see SubmissionPartitionManager
+INITIAL_DAILY_PARTITIONS = 3
+
+
+def get_columns():
+    return [
+        sa.Column("id", sa.UUID, nullable=False),
+        sa.Column(
+            "status",
+            sa.String(50),
+            CheckConstraint("status IN ('pending', 'processed')"),
+            nullable=False
+        ),
+        sa.Column("number_of_delivered_events", sa.Integer, nullable=False, default=0),
+        sa.Column("sequence_number", sa.Text, nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("deleted_at", sa.DateTime(timezone=True), nullable=True),
+    ]
+
+
+def upgrade() -> None:
+    op.rename_table("submissions", "submissions_unpartitioned")
+    op.execute("ALTER INDEX submissions_pkey RENAME TO submissions_unpartitioned_pkey")
+    # a primary key of a partitioned table includes the partition key,
+    # so the claim locks submission IDs instead of relying on the key
+    op.create_table(
+        "submissions",
+        *get_columns(),
+        sa.PrimaryKeyConstraint("id", "created_at", name="submissions_pkey"),
+        postgresql_partition_by="RANGE (created_at)",
+    )
+    op.create_index("ix_submissions_id", "submissions", ["id"])
+    # rows out of the daily partitions, e.g. the ones created before this migration
+    op.execute("CREATE TABLE submissions_default PARTITION OF submissions DEFAULT")
+    today = datetime.now(UTC).date()
+    for days in range(INITIAL_DAILY_PARTITIONS):
+        start = today + timedelta(days=days)
+        end = start + timedelta(days=1)
+        op.execute(
+            f"CREATE TABLE submissions_p{start:%Y%m%d} PARTITION OF submissions "
+            f"FOR VALUES FROM ('{start.isoformat()}T00:00:00+00:00') TO ('{end.isoformat()}T00:00:00+00:00')"
+        )
+    op.execute("INSERT INTO submissions SELECT * FROM submissions_unpartitioned")
+    op.drop_table("submissions_unpartitioned")
+
+
+def downgrade() -> None:
+    op.rename_table("submissions", "submissions_partitioned")
+    op.execute("ALTER INDEX submissions_pkey RENAME TO submissions_partitioned_pkey")
+    op.create_table(
+        "submissions",
+        *get_columns(),
+        sa.PrimaryKeyConstraint("id", name="submissions_pkey"),
+    )
+    # a submission has one row, the lock in the claim guarantees it
+    op.execute("INSERT INTO submissions SELECT * FROM submissions_partitioned")
+    op.drop_table("submissions_partitioned")
@@ -0,0 +1,34 @@
+"""add submission leases
+
+Revision ID: 9e4c2b7a61d3
+Revises: 5b1d9e0f2a7c
+Create Date: 2026-10-18 15:02:44.910376
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '9e4c2b7a61d3'
+down_revision: Union[str, None] = '5b1d9e0f2a7c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # a pending submission is leased by a worker until lease_expires_at;
+    # the pending rows without a lease are taken over by the next claim
+    op.add_column("submissions", sa.Column("owner_id", sa.Text, nullable=True))
+    op.add_column("submissions", sa.Column("lease_expires_at", sa.DateTime(timezone=True), nullable=True))
+    op.add_column(
+        "submissions",
+        sa.Column("fencing_token", sa.BigInteger, nullable=False, server_default="0"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("submissions", "fencing_token")
+    op.drop_column("submissions", "lease_expires_at")
+    op.drop_column("submissions", "owner_id")
@@ -0,0 +1,86 @@
+import secrets
+from typing import Annotated, Any, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import Response
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+from app.settings import Settings, get_settings
+from app.worker.profiling import ProfilerBusyError, profile_event_loop
+from app.worker.tuning import ParametersUnavailableError, PipelineParameters, PipelineParametersUpdate
+from app.worker.worker import Worker, get_worker
+
+bearer = HTTPBearer(auto_error=False)
+
+
+def verify_admin_token(
+    settings: Annotated[Settings, Depends(get_settings)],
+    credentials: Annotated[Optional[HTTPAuthorizationCredentials], Depends(bearer)],
+):
+    if settings.admin_token is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "The admin API is disabled")
+    if credentials is None or not secrets.compare_digest(
+        credentials.credentials.encode(), settings.admin_token.get_secret_value().encode()
+    ):
+        raise HTTPException(
+            status.HTTP_401_UNAUTHORIZED,
+            "Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(verify_admin_token)])
+
+
+@router.get("/profile", response_class=Response)
+async def get_profile(
+    worker: Annotated[Worker, Depends(get_worker)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    seconds: Annotated[float, Query(gt=0)] = 10.0,
+) -> Response:
+    if not isinstance(worker, Worker):
+        raise HTTPException(
+            status.HTTP_501_NOT_IMPLEMENTED,
+            "Profiling is available when the worker runs in the server process (WORKER_PROCESSES=1)",
+        )
+    if seconds > settings.max_profile_duration:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"The profile duration exceeds {settings.max_profile_duration} seconds",
+        )
+    try:
+        stats = await profile_event_loop(seconds)
+    except ProfilerBusyError as ex:
+        raise HTTPException(status.HTTP_409_CONFLICT, str(ex))
+    return Response(
+        stats,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="worker.prof"'},
+    )
+
+
+@router.get("/slow-submissions")
+async def get_slow_submissions(worker: Annotated[Worker, Depends(get_worker)]) -> List[Dict[str, Any]]:
+    return worker.collect_slow_submissions()
+
+
+@router.get("/parameters")
+async def get_parameters(worker: Annotated[Worker, Depends(get_worker)]) -> PipelineParameters:
+    try:
+        return worker.get_parameters()
+    except ParametersUnavailableError as ex:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, str(ex))
+
+
+@router.patch("/parameters")
+async def update_parameters(
+    worker: Annotated[Worker, Depends(get_worker)],
+    changes: PipelineParametersUpdate,
+) -> PipelineParameters:
+    try:
+        return await worker.update_parameters(changes)
+    except ParametersUnavailableError as ex:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, str(ex))
+    except ValueError as ex:
+        # pydantic.ValidationError too, e.g. max_pool_size < min_pool_size
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(ex))
@@ -1,6 +1,9 @@
 from typing import Annotated
 
 from fastapi import Depends, APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.metrics import render_prometheus
 
 from app.worker.worker import Worker, get_worker
 
@@ -11,3 +14,11 @@ router = APIRouter()
 @router.get("/healthcheck")
 def ping(worker: Annotated[Worker, Depends(get_worker)]) -> dict:
     return {"worker_status": "OK" if worker.status else "Fail"}
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(worker: Annotated[Worker, Depends(get_worker)]) -> PlainTextResponse:
+    return PlainTextResponse(
+        render_prometheus(worker.collect_metrics()),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -0,0 +1,205 @@
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Literal, Mapping, Sequence, Tuple
+
+LabelValues = Tuple[Tuple[str, str], ...]
+# how the values of processes are merged: a sum, or the maximum for values
+# that are the same in every process, e.g. settings
+Aggregation = Literal["sum", "max"]
+# {name: (type, description, {label values: value}, aggregation)}
+MetricsSnapshot = Dict[str, Tuple[str, str, Dict[LabelValues, float], Aggregation]]
+
+# a histogram sample has this label with the suffix of its name:
+# _bucket (with the "le" label), _sum or _count
+SAMPLE_LABEL = "__sample"
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+
+def _get_label_values(labels: Mapping[str, str]) -> LabelValues:
+    if not labels:
+        return ()
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metric:
+    type = "untyped"
+    aggregation: Aggregation = "sum"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[LabelValues, float] = {}
+
+    def get(self, **labels) -> float:
+        return self._values.get(_get_label_values(labels), 0)
+
+    def snapshot(self) -> Dict[LabelValues, float]:
+        return dict(self._values)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = _get_label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, aggregation: Aggregation = "sum"):
+        super().__init__(name, description)
+        self.aggregation = aggregation
+
+    def set(self, value: float, **labels):
+        self._values[_get_label_values(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = _get_label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Counts observations in buckets. An observation is a binary search and
+    two additions, so it is cheap enough for every request.
+
+    Snapshot samples are cumulative like in Prometheus, so the snapshots
+    of several processes are merged by adding them up.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = sorted(buckets)
+        # {label values: [the bucket counts + the +Inf count, the sum]}
+        self._observations: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _get_label_values(labels)
+        observations = self._observations.get(key)
+        if observations is None:
+            observations = self._observations[key] = [0] * (len(self.buckets) + 2)
+        observations[bisect_left(self.buckets, value)] += 1
+        observations[-1] += value
+
+    def get(self, **labels) -> float:
+        observations = self._observations.get(_get_label_values(labels))
+        return sum(observations[:-1]) if observations else 0
+
+    def snapshot(self) -> Dict[LabelValues, float]:
+        samples = {}
+        for key, observations in self._observations.items():
+            count = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), observations):
+                count += bucket_count
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                samples[key + ((SAMPLE_LABEL, "_bucket"), ("le", le))] = count
+            samples[key + ((SAMPLE_LABEL, "_sum"),)] = observations[-1]
+            samples[key + ((SAMPLE_LABEL, "_count"),)] = count
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Keeps the metrics of a process.
+
+    Snapshots are plain picklable structures, so worker processes can
+    send them to the supervisor that merges them into one view.
+    """
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str = "", aggregation: Aggregation = "sum") -> Gauge:
+        return self._get_or_create(Gauge, name, description, aggregation)
+
+    def histogram(
+        self, name: str, description: str = "", buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, description, buckets)
+
+    def add_collector(self, collector: Callable[[], None]):
+        """
+        Adds a callback that updates metrics before every snapshot,
+        e.g. from the stats of a connection pool.
+        """
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], None]):
+        self._collectors.remove(collector)
+
+    def _get_or_create(self, metric_class, name, description, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = metric_class(name, description, *args)
+            self._metrics[name] = metric
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f"The metric {name} is a {metric.type}")
+        return metric
+
+    def snapshot(self) -> MetricsSnapshot:
+        for collector in self._collectors:
+            collector()
+        return {
+            name: (metric.type, metric.description, metric.snapshot(), metric.aggregation)
+            for name, metric in self._metrics.items()
+        }
+
+
+def merge_snapshots(snapshots: Iterable[MetricsSnapshot]) -> MetricsSnapshot:
+    merged: MetricsSnapshot = {}
+    for snapshot in snapshots:
+        for name, (type_, description, values, aggregation) in snapshot.items():
+            _, _, merged_values, _ = merged.setdefault(name, (type_, description, {}, aggregation))
+            for label_values, value in values.items():
+                if label_values not in merged_values:
+                    merged_values[label_values] = value
+                elif aggregation == "max":
+                    merged_values[label_values] = max(merged_values[label_values], value)
+                else:
+                    merged_values[label_values] += value
+    return merged
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_values: Iterable[Tuple[str, str]]) -> str:
+    labels = ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in label_values)
+    return f"{{{labels}}}" if labels else ""
+
+
+def render_prometheus(snapshot: MetricsSnapshot) -> str:
+    """
+    Renders a snapshot in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, (type_, description, values, _) in sorted(snapshot.items()):
+        if description:
+            lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {type_}")
+        for label_values, value in values.items():
+            suffix = ""
+            labels = []
+            for k, v in label_values:
+                if k == SAMPLE_LABEL:
+                    suffix = v
+                else:
+                    labels.append((k, v))
+            lines.append(f"{name}{suffix}{_format_labels(labels)} {value!r}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+registry = MetricsRegistry()
@@ -1,23 +1,117 @@
 from functools import cache
-from typing import Optional
+from importlib.util import find_spec
+from typing import Optional, Annotated, Literal
 
-from pydantic import PositiveInt, NonNegativeInt
+from pydantic import (
+    SecretStr, Field, PositiveInt, NonNegativeInt, NonNegativeFloat, PositiveFloat, model_validator
+)
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
     debug: bool = False
-    queue_url: str
+    admin_token: Optional[SecretStr] = None
+    max_profile_duration: PositiveFloat = 60.0
+    slow_submissions_log_size: PositiveInt = 50
+    slow_submissions_window: PositiveFloat = 900.0
+    # "file" replays submissions from files instead of the queue
+    source: Literal["sqs", "file"] = "sqs"
+    queue_url: Optional[str] = None
+    file_source_pattern: Optional[str] = None
+    file_source_format: Literal["auto", "ndjson", "base64"] = "auto"
+    file_source_batch_size: PositiveInt = 100
+    file_source_mmap: bool = True
+    file_source_checkpoint_path: Optional[str] = None
+    file_source_checkpoint_interval: PositiveFloat = 5.0
     endpoint_url: str
     db_url: str
     max_message_number_by_request: PositiveInt
     sqs_visibility_timeout: PositiveInt
     message_wait_time: NonNegativeInt
+    adaptive_receive: bool = False
+    min_message_number_by_request: Annotated[int, Field(ge=1, le=10)] = 1
+    min_message_wait_time: NonNegativeInt = 0
+    max_pollers: PositiveInt = 4
+    target_processing_latency: PositiveFloat = 5.0
+    receive_adjust_interval: PositiveFloat = 5.0
+    visibility_heartbeat: bool = True
+    visibility_heartbeat_interval: Optional[PositiveFloat] = None
+    visibility_max_extension: PositiveFloat = 900.0
+    worker_processes: NonNegativeInt = 1
+    worker_heartbeat_timeout: PositiveFloat = 30.0
+    worker_restart_timeout: PositiveFloat = 5.0
+    worker_shutdown_timeout: PositiveFloat = 30.0
+    drain_timeout: PositiveFloat = 20.0
+    pollers: PositiveInt = 1
+    publishers: PositiveInt = 2
+    max_in_flight_submissions: PositiveInt = 100
+    publish_batch_size: PositiveInt = 10
+    pipeline_queue_size: PositiveInt = 50
+    prefetch_buffer_size: PositiveInt = 1
+    prefetch_max_age_ratio: Annotated[float, Field(gt=0, lt=1)] = 0.5
+    ack_batch_size: Annotated[int, Field(ge=1, le=10)] = 10
+    ack_batch_linger: NonNegativeFloat = 0.05
+    completed_submissions_cache_size: NonNegativeInt = 100_000
+    completed_submissions_cache_ttl: PositiveFloat = 3600.0
     min_pool_size: NonNegativeInt = 5
     max_pool_size: Optional[NonNegativeInt] = None
+    # daily partitions of submissions older than the retention are dropped,
+    # so redelivered submissions are deduplicated within this window
+    submission_retention: bool = True
+    submission_retention_days: PositiveInt = 7
+    submission_partitions_ahead: PositiveInt = 2
+    submission_retention_interval: PositiveFloat = 3600.0
+    # a worker leases the submissions it publishes, and the submissions
+    # of a crashed worker are taken over after the lease expires
+    submission_lease_ttl: PositiveFloat = 60.0
+    aws_max_pool_connections: PositiveInt = 50
+    aws_connect_timeout: PositiveFloat = 5.0
+    aws_read_timeout: PositiveFloat = 30.0
+    aws_keepalive_timeout: PositiveFloat = 60.0
+    aws_tcp_keepalive: bool = True
+    kinesis_stream_name: str = "events"
+    kinesis_batch_linger: NonNegativeFloat = 0.0
+    kinesis_max_attempts: PositiveInt = 3
+    kinesis_retry_timeout: NonNegativeFloat = 0.1
+    kinesis_max_concurrent_requests: PositiveInt = 4
+    kinesis_shard_aware: bool = True
+    kinesis_shard_queue_size: PositiveInt = 1000
+    kinesis_shard_map_refresh_interval: PositiveFloat = 60.0
+    kinesis_rate_control: bool = True
+    kinesis_max_records_rate: PositiveFloat = 1000.0
+    kinesis_min_records_rate: PositiveFloat = 10.0
+    kinesis_rate_increase: PositiveFloat = 50.0
+    kinesis_rate_decrease_factor: Annotated[float, Field(gt=0, lt=1)] = 0.5
+    kinesis_throttle_retry_deadline: NonNegativeFloat = 10.0
+    event_encoding: Literal["json", "compact"] = "json"
+    kinesis_aggregation: bool = False
+    kinesis_aggregation_max_bytes: Annotated[int, Field(gt=0, le=1_000_000)] = 25 * 1024
+    kinesis_compression: Literal["none", "zlib", "zstd"] = "none"
+    kinesis_compression_level: Optional[int] = None
+    kinesis_compression_dictionary: Optional[str] = None
 
     model_config = SettingsConfigDict(env_file=".env", extra="allow")
 
+    @model_validator(mode="after")
+    def check_source(self) -> "Settings":
+        if self.source == "sqs" and not self.queue_url:
+            raise ValueError("QUEUE_URL is required for the SQS source")
+        if self.source == "file" and not self.file_source_pattern:
+            raise ValueError("FILE_SOURCE_PATTERN is required for the file source")
+        if self.source == "file" and self.worker_processes != 1:
+            # every process would read all files
+            raise ValueError("the file source requires WORKER_PROCESSES=1")
+        return self
+
+    @model_validator(mode="after")
+    def check_compression(self) -> "Settings":
+        if self.kinesis_compression == "zstd" and find_spec("zstandard") is None:
+            raise ValueError(
+                "KINESIS_COMPRESSION=zstd requires the zstandard package, "
+                "install it with the zstd extra: poetry install --extras zstd"
+            )
+        return self
+
 
 @cache
 def get_settings() -> Settings:
@@ -0,0 +1,234 @@
+import logging
+from contextlib import asynccontextmanager, AsyncExitStack
+from datetime import timedelta
+from functools import partial
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+
+from app.metrics import registry
+from app.settings import Settings
+from app.worker.infrastructure.ack_coalescer import AckCoalescer
+from app.worker.infrastructure.clients.file_source import FileSource
+from app.worker.infrastructure.clients.interfaces import QueueClient, SubmissionStateStore
+from app.worker.infrastructure.clients.kinesis import KinesisClient
+from app.worker.infrastructure.clients.receive_controller import ReceiveController
+from app.worker.infrastructure.clients.session_manager import AWSSessionManager, get_client_config
+from app.worker.infrastructure.clients.sqs import SQSClient
+from app.worker.infrastructure.clients.submission_store import (
+    PostgresSubmissionStore, export_pool_stats
+)
+from app.worker.infrastructure.compression import RecordCompressor
+from app.worker.infrastructure.event_streamer import KinesisStreamer
+from app.worker.infrastructure.kinesis_batcher import KinesisRecordBatcher
+from app.worker.infrastructure.rate_limiter import AIMDRateLimiter
+from app.worker.infrastructure.serialization import get_event_encoder
+from app.worker.infrastructure.shard_writer import ShardedKinesisWriter
+from app.worker.infrastructure.submission_retention import SubmissionPartitionManager
+from app.worker.infrastructure.visibility_tracker import VisibilityTracker
+from app.worker.services.cache import CompletedSubmissionCache
+from app.worker.services.submission import TelemetryService
+from app.worker.tracing import SlowSubmissionsLog
+from app.worker.worker import Worker
+
+logger = logging.getLogger(__name__)
+
+
+def get_record_compressor(settings: Settings) -> Optional[RecordCompressor]:
+    if settings.kinesis_compression == "none":
+        return None
+    dictionary = None
+    if settings.kinesis_compression_dictionary:
+        dictionary = Path(settings.kinesis_compression_dictionary).read_bytes()
+    return RecordCompressor(
+        settings.kinesis_compression, settings.kinesis_compression_level, dictionary
+    )
+
+
+def create_sqs_client(settings: Settings, sqs) -> SQSClient:
+    receive_controller = None
+    if settings.adaptive_receive:
+        receive_controller = ReceiveController(
+            settings.min_message_number_by_request,
+            settings.max_message_number_by_request,
+            settings.min_message_wait_time,
+            settings.message_wait_time,
+            settings.pollers,
+            settings.max_pollers,
+            settings.target_processing_latency,
+            settings.receive_adjust_interval,
+        )
+    return SQSClient(
+        sqs,
+        settings.queue_url,
+        settings.max_message_number_by_request,
+        settings.sqs_visibility_timeout,
+        settings.message_wait_time,
+        receive_controller,
+    )
+
+
+def create_file_source(settings: Settings) -> FileSource:
+    return FileSource(
+        settings.file_source_pattern,
+        settings.file_source_format,
+        settings.file_source_batch_size,
+        settings.sqs_visibility_timeout,
+        settings.file_source_checkpoint_path,
+        settings.file_source_checkpoint_interval,
+        settings.file_source_mmap,
+    )
+
+
+async def build_worker(
+    settings: Settings,
+    stack: AsyncExitStack,
+    queue_client: QueueClient,
+    kinesis_client: KinesisClient,
+    submission_store: SubmissionStateStore,
+    connection_pool: Optional[AsyncConnectionPool] = None,
+) -> Worker:
+    """
+    Builds the pipeline on top of the clients. The background components
+    are stopped by `stack`.
+    """
+    pollers = settings.pollers
+    if queue_client.get_pollers() is not None:
+        # the client tunes the number of active pollers up to max_pollers
+        pollers = max(settings.pollers, settings.max_pollers)
+    batcher_options = dict(
+        linger=settings.kinesis_batch_linger,
+        max_attempts=settings.kinesis_max_attempts,
+        retry_timeout=settings.kinesis_retry_timeout,
+        max_concurrent_requests=settings.kinesis_max_concurrent_requests,
+        throttle_retry_deadline=settings.kinesis_throttle_retry_deadline,
+    )
+    rate_limiter_factory = None
+    if settings.kinesis_rate_control:
+        rate_limiter_factory = partial(
+            AIMDRateLimiter,
+            settings.kinesis_max_records_rate,
+            settings.kinesis_min_records_rate,
+            settings.kinesis_rate_increase,
+            settings.kinesis_rate_decrease_factor,
+        )
+    if settings.kinesis_shard_aware:
+        kinesis_batcher = await stack.enter_async_context(ShardedKinesisWriter(
+            kinesis_client,
+            settings.kinesis_stream_name,
+            refresh_interval=settings.kinesis_shard_map_refresh_interval,
+            rate_limiter_factory=rate_limiter_factory,
+            max_pending_records=settings.kinesis_shard_queue_size,
+            **batcher_options,
+        ))
+    else:
+        kinesis_batcher = await stack.enter_async_context(KinesisRecordBatcher(
+            kinesis_client,
+            settings.kinesis_stream_name,
+            rate_limiter=rate_limiter_factory() if rate_limiter_factory else None,
+            **batcher_options,
+        ))
+    kinesis_streamer = KinesisStreamer(
+        kinesis_batcher,
+        submission_store,
+        get_event_encoder(settings.event_encoding),
+        settings.kinesis_aggregation_max_bytes if settings.kinesis_aggregation else None,
+        get_record_compressor(settings),
+    )
+    acknowledger = await stack.enter_async_context(AckCoalescer(
+        queue_client,
+        settings.ack_batch_size,
+        settings.ack_batch_linger,
+    ))
+    visibility_tracker = None
+    max_message_age = settings.sqs_visibility_timeout * settings.prefetch_max_age_ratio
+    if settings.visibility_heartbeat:
+        visibility_tracker = await stack.enter_async_context(VisibilityTracker(
+            queue_client,
+            settings.sqs_visibility_timeout,
+            settings.visibility_heartbeat_interval or settings.sqs_visibility_timeout / 3,
+            settings.visibility_max_extension,
+        ))
+        # prefetched messages are extended too
+        max_message_age = settings.visibility_max_extension
+    submission_service = TelemetryService(
+        queue_client,
+        kinesis_streamer,
+        acknowledger,
+        CompletedSubmissionCache(
+            settings.completed_submissions_cache_size,
+            settings.completed_submissions_cache_ttl,
+        ),
+        visibility_tracker,
+    )
+    return Worker(
+        submission_service,
+        pollers,
+        settings.publishers,
+        settings.max_in_flight_submissions,
+        settings.publish_batch_size,
+        settings.prefetch_buffer_size,
+        settings.pipeline_queue_size,
+        max_message_age,
+        SlowSubmissionsLog(settings.slow_submissions_log_size, settings.slow_submissions_window),
+        settings.drain_timeout,
+        connection_pool,
+    )
+
+
+@asynccontextmanager
+async def create_worker(settings: Settings) -> AsyncIterator[Worker]:
+    async with AsyncExitStack() as stack:
+        pg_pool = await stack.enter_async_context(AsyncConnectionPool(
+            conninfo=settings.db_url,
+            min_size=settings.min_pool_size,
+            max_size=settings.max_pool_size,
+            check=AsyncConnectionPool.check_connection,
+            timeout=15
+        ))
+        try:
+            async with pg_pool.connection() as conn:
+                logger.debug("check the DB connection")
+                await conn.execute("SELECT 1")
+        except psycopg.OperationalError:
+            logger.error(f"No database connection: {settings.db_url}")
+            raise
+        pool_stats_collector = partial(export_pool_stats, pg_pool)
+        registry.add_collector(pool_stats_collector)
+        stack.callback(registry.remove_collector, pool_stats_collector)
+        if settings.submission_retention:
+            await stack.enter_async_context(SubmissionPartitionManager(
+                pg_pool,
+                timedelta(days=settings.submission_retention_days),
+                settings.submission_partitions_ahead,
+                settings.submission_retention_interval,
+            ))
+
+        aws_client_config = get_client_config(
+            settings.aws_max_pool_connections,
+            settings.aws_connect_timeout,
+            settings.aws_read_timeout,
+            settings.aws_keepalive_timeout,
+            settings.aws_tcp_keepalive,
+        )
+        if settings.source == "file":
+            queue_client = await stack.enter_async_context(create_file_source(settings))
+        else:
+            sqs = await stack.enter_async_context(AWSSessionManager(
+                "sqs", endpoint_url=settings.endpoint_url, config=aws_client_config
+            ))
+            queue_client = create_sqs_client(settings, sqs)
+        kinesis = await stack.enter_async_context(AWSSessionManager(
+            "kinesis", endpoint_url=settings.endpoint_url, config=aws_client_config
+        ))
+
+        submission_store = await stack.enter_async_context(PostgresSubmissionStore(
+            pg_pool,
+            settings.submission_lease_ttl,
+            settings.visibility_max_extension,
+        ))
+        yield await build_worker(
+            settings, stack, queue_client, KinesisClient(kinesis), submission_store, pg_pool
+        )
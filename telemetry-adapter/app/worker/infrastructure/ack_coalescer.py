@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from typing import List, Optional, Set, Tuple
+
+from app.worker.infrastructure.clients.exceptions import (
+    QueueClientException, QueueClientReceivingException
+)
+from app.worker.infrastructure.clients.interfaces import QueueClient
+
+logger = logging.getLogger(__name__)
+
+# DeleteMessageBatch accepts up to 10 entries
+MAX_BATCH_SIZE = 10
+
+
+class AckCoalescer:
+    """
+    Collects deletion IDs of processed messages and deletes them in batches.
+
+    A batch is flushed when it is full or after `linger` seconds. The caller
+    awaits `ack` until its message is deleted, and a failed entry raises
+    an exception for this caller only.
+    """
+    def __init__(
+        self,
+        queue_client: QueueClient,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        linger: float = 0.05,
+    ):
+        self.queue_client = queue_client
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_SIZE)
+        self.linger = linger
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._deletions: Set[asyncio.Task] = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def ack(self, deletion_id: str):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((deletion_id, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.linger, self._flush)
+        await future
+
+    async def close(self):
+        while self._pending:
+            self._flush()
+        await asyncio.gather(*self._deletions, return_exceptions=True)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch = self._pending[:self.max_batch_size]
+        del self._pending[:self.max_batch_size]
+        if self._pending:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.linger, self._flush)
+        if not batch:
+            return
+        task = asyncio.create_task(self._delete(batch))
+        self._deletions.add(task)
+        task.add_done_callback(self._deletions.discard)
+
+    async def _delete(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            failed = await self.queue_client.delete_messages([deletion_id for deletion_id, _ in batch])
+        except QueueClientException as ex:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        for deletion_id, future in batch:
+            if future.done():
+                continue
+            if deletion_id in failed:
+                future.set_exception(QueueClientReceivingException(failed[deletion_id]))
+            else:
+                future.set_result(None)
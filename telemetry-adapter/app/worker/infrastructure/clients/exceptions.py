@@ -18,3 +18,7 @@ class QueueClientUnexpectedMessage(QueueClientException):
 
 class KinesisClientException(Exception):
     pass
+
+
+class SubmissionStoreException(Exception):
+    pass
@@ -0,0 +1,323 @@
+import asyncio
+import binascii
+import bz2
+import glob
+import gzip
+import json
+import logging
+import lzma
+import mmap
+import os
+from collections import deque
+from pathlib import Path
+from typing import Any, BinaryIO, Deque, Dict, Iterable, List, Literal, Mapping, Optional, Sequence, Set, Tuple
+
+from app.metrics import registry
+from app.worker.infrastructure.clients.exceptions import (
+    QueueClientReceivingException, QueueClientUnexpectedMessage
+)
+from app.worker.infrastructure.clients.interfaces import QueueClient
+
+logger = logging.getLogger(__name__)
+
+read_lines = registry.counter("file_source_lines_total", "Lines read from input files")
+read_bytes = registry.counter("file_source_bytes_total", "Decompressed bytes read from input files")
+committed_bytes = registry.gauge(
+    "file_source_committed_bytes", "Bytes of input files whose submissions are processed"
+)
+
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+FileFormat = Literal["auto", "ndjson", "base64"]
+# a file index, the line start, the line end, the line
+Line = Tuple[int, int, int, bytes]
+
+
+class _InputFile:
+    """
+    Reads lines of a file from a byte offset of its decompressed content.
+    An uncompressed file may be memory-mapped.
+    """
+    def __init__(self, index: int, path: Path, offset: int, use_mmap: bool):
+        self.index = index
+        self.path = path
+        self.use_mmap = use_mmap
+        # the offset of the next line to read
+        self.offset = offset
+        self.is_read = False
+        # starts of lines that are read and not acknowledged, in file order
+        self.pending: Deque[int] = deque()
+        self.acknowledged: Set[int] = set()
+        self._stream: Optional[BinaryIO] = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    def read_lines(self, limit: int) -> Tuple[List[Line], int]:
+        """
+        Returns up to `limit` non-empty lines and the offset after them.
+        Called in a thread, so it does not change the state of the file.
+        """
+        if self._stream is None and self._mmap is None:
+            self._open()
+        lines: List[Line] = []
+        offset = self.offset
+        while len(lines) < limit:
+            if self._mmap is not None:
+                if offset >= len(self._mmap):
+                    break
+                end = self._mmap.find(b"\n", offset)
+                end = len(self._mmap) if end == -1 else end + 1
+                line = self._mmap[offset:end]
+            else:
+                line = self._stream.readline()
+                if not line:
+                    break
+                end = offset + len(line)
+            if line.strip():
+                lines.append((self.index, offset, end, line.rstrip(b"\r\n")))
+            offset = end
+        return lines, offset
+
+    def get_committed_offset(self) -> int:
+        while self.pending and self.pending[0] in self.acknowledged:
+            self.acknowledged.remove(self.pending.popleft())
+        return self.pending[0] if self.pending else self.offset
+
+    def is_completed(self) -> bool:
+        return self.is_read and not self.pending
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _open(self):
+        opener = COMPRESSED_OPENERS.get(self.path.suffix)
+        if opener is not None:
+            self._stream = opener(self.path, "rb")
+            # compressed streams are decompressed up to the offset
+            self._stream.seek(self.offset)
+            return
+        if self.use_mmap and self.path.stat().st_size > 0:
+            with open(self.path, "rb") as file:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+            return
+        self._stream = open(self.path, "rb")
+        self._stream.seek(self.offset)
+
+
+class FileSource(QueueClient):
+    """
+    Replays submissions from NDJSON files or files of base64 encoded
+    submissions, one per line, instead of a queue. Files ending with .gz,
+    .bz2 or .xz are decompressed on the fly; other files are memory-mapped
+    or streamed, so large files are not loaded in memory.
+
+    A deletion acknowledges a line. Like a queue message, a line that is
+    not deleted in `visibility_timeout` seconds, or is released, is read again.
+    The offsets before the first unacknowledged line of every file are
+    saved to `checkpoint_path`, so a restarted replay skips processed lines.
+    """
+    def __init__(
+        self,
+        pattern: str,
+        file_format: FileFormat = "auto",
+        max_message_number: int = 10,
+        visibility_timeout: float = 30.0,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_interval: float = 5.0,
+        use_mmap: bool = True,
+        read_ahead: int = 1000,
+        idle_timeout: float = 1.0,
+    ):
+        self.file_format = file_format
+        self.max_message_number = max_message_number
+        self.visibility_timeout = visibility_timeout
+        self.checkpoint_path = Path(checkpoint_path) if checkpoint_path else None
+        self.checkpoint_interval = checkpoint_interval
+        self.read_ahead = max(read_ahead, max_message_number)
+        self.idle_timeout = idle_timeout
+        offsets = self._load_checkpoint()
+        self._files = [
+            _InputFile(i, Path(path), offsets.get(path, 0), use_mmap)
+            for i, path in enumerate(sorted(glob.glob(pattern)))
+        ]
+        if not self._files:
+            logger.warning(f"no input files match {pattern}")
+        self._current = 0
+        self._buffer: Deque[Line] = deque()
+        # lines to read again, {deletion ID: line}
+        self._released: Dict[str, Line] = {}
+        # {deletion ID: (line, visible at)}
+        self._in_flight: Dict[str, Tuple[Line, float]] = {}
+        self._expiration_checked_at = 0.0
+        self._read_lock = asyncio.Lock()
+        self._checkpointing: Optional[asyncio.Task] = None
+        self._is_completed = False
+
+    async def __aenter__(self):
+        if self.checkpoint_path is not None:
+            self._checkpointing = asyncio.create_task(self._run_checkpointing())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._checkpointing is not None:
+            self._checkpointing.cancel()
+            await asyncio.gather(self._checkpointing, return_exceptions=True)
+        self.save_checkpoint()
+        for file in self._files:
+            file.close()
+
+    async def get_messages(self) -> Iterable[Mapping[str, Any]]:
+        lines = self._take_released()
+        if len(lines) < self.max_message_number:
+            async with self._read_lock:
+                if not self._buffer:
+                    await self._fill_buffer()
+                while self._buffer and len(lines) < self.max_message_number:
+                    lines.append(self._buffer.popleft())
+        if not lines:
+            self._check_completion()
+            # nothing to read until a message is released
+            await asyncio.sleep(self.idle_timeout)
+        messages = []
+        visible_at = asyncio.get_running_loop().time() + self.visibility_timeout
+        for line in lines:
+            deletion_id = f"{line[0]}:{line[1]}"
+            self._in_flight[deletion_id] = (line, visible_at)
+            messages.append({"MessageId": deletion_id, "Body": line[3]})
+        return messages
+
+    async def delete_message(self, id_):
+        failed = await self.delete_messages([id_])
+        if failed:
+            raise QueueClientReceivingException(failed[id_])
+
+    async def delete_messages(self, ids: Sequence[str]) -> Mapping[str, str]:
+        failed = {}
+        for deletion_id in ids:
+            in_flight = self._in_flight.pop(deletion_id, None)
+            if in_flight is None:
+                failed[deletion_id] = "the message is not in processing"
+                continue
+            file = self._files[in_flight[0][0]]
+            file.acknowledged.add(in_flight[0][1])
+            file.get_committed_offset()
+        return failed
+
+    async def change_visibility(self, ids: Sequence[str], visibility_timeout: int) -> Mapping[str, str]:
+        visible_at = asyncio.get_running_loop().time() + visibility_timeout
+        failed = {}
+        for deletion_id in ids:
+            in_flight = self._in_flight.get(deletion_id)
+            if in_flight is None:
+                failed[deletion_id] = "the message is not in processing"
+            elif visibility_timeout == 0:
+                del self._in_flight[deletion_id]
+                self._released[deletion_id] = in_flight[0]
+            else:
+                self._in_flight[deletion_id] = (in_flight[0], visible_at)
+        return failed
+
+    def get_receive_options(self) -> Tuple[int, int]:
+        # lines are read without waiting
+        return self.max_message_number, 0
+
+    def set_receive_options(self, max_message_number: int, wait_time: int, max_pollers: int):
+        if wait_time:
+            raise ValueError("The file source does not wait for messages")
+        self.max_message_number = max_message_number
+        self.read_ahead = max(self.read_ahead, max_message_number)
+
+    def get_deletion_id(self, message: Mapping[str, Any]) -> str:
+        return message["MessageId"]
+
+    def get_submission_body(self, message: Mapping[str, Any]) -> bytes:
+        body = message["Body"]
+        if self.file_format == "ndjson" or (self.file_format == "auto" and body.startswith(b"{")):
+            return body
+        try:
+            return binascii.a2b_base64(body)
+        except binascii.Error as ex:
+            err_msg = f"The invalid base64 line: {ex}. Message: {message['MessageId']}"
+            logger.warning(err_msg)
+            raise QueueClientUnexpectedMessage(msg=err_msg)
+
+    def get_submission_from_message(self, message: Mapping[str, Any]) -> Mapping[str, Any]:
+        try:
+            return json.loads(self.get_submission_body(message))
+        except ValueError as ex:
+            err_msg = f"The invalid JSON line: {ex}. Message: {message['MessageId']}"
+            logger.warning(err_msg)
+            raise QueueClientUnexpectedMessage(msg=err_msg)
+
+    def get_offsets(self) -> Dict[str, int]:
+        return {str(file.path): file.get_committed_offset() for file in self._files}
+
+    def save_checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        offsets = self.get_offsets()
+        committed_bytes.set(sum(offsets.values()))
+        temporary_path = self.checkpoint_path.with_name(self.checkpoint_path.name + ".tmp")
+        temporary_path.write_text(json.dumps({"offsets": offsets}))
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def _load_checkpoint(self) -> Dict[str, int]:
+        if self.checkpoint_path is None or not self.checkpoint_path.exists():
+            return {}
+        offsets = json.loads(self.checkpoint_path.read_text())["offsets"]
+        logger.info(f"resume reading files from the checkpoint {self.checkpoint_path}")
+        return offsets
+
+    async def _run_checkpointing(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                self.save_checkpoint()
+            except OSError as ex:
+                logger.warning(f"can not save the checkpoint {self.checkpoint_path}: {ex}")
+
+    def _take_released(self) -> List[Line]:
+        now = asyncio.get_running_loop().time()
+        if now - self._expiration_checked_at >= 1:
+            self._expiration_checked_at = now
+            for deletion_id, (line, visible_at) in list(self._in_flight.items()):
+                if visible_at <= now:
+                    del self._in_flight[deletion_id]
+                    self._released[deletion_id] = line
+        lines = []
+        while self._released and len(lines) < self.max_message_number:
+            lines.append(self._released.pop(next(iter(self._released))))
+        return lines
+
+    async def _fill_buffer(self):
+        while self._current < len(self._files):
+            file = self._files[self._current]
+            try:
+                lines, offset = await asyncio.to_thread(file.read_lines, self.read_ahead)
+            except (OSError, EOFError, lzma.LZMAError, ValueError) as ex:
+                logger.warning(f"Error while reading the file {file.path}: {ex}")
+                raise QueueClientReceivingException from ex
+            read_lines.inc(len(lines))
+            read_bytes.inc(offset - file.offset)
+            file.pending.extend(line[1] for line in lines)
+            file.offset = offset
+            self._buffer.extend(lines)
+            if lines:
+                return
+            file.is_read = True
+            file.close()
+            logger.info(f"the file {file.path} is read")
+            self._current += 1
+
+    def _check_completion(self):
+        if self._is_completed or self._in_flight or self._current < len(self._files):
+            return
+        if all(file.is_completed() for file in self._files):
+            self._is_completed = True
+            logger.info(f"all lines of {len(self._files)} files are processed")
@@ -1,20 +1,81 @@
 from abc import ABC, abstractmethod
-from typing import Mapping, Any, Iterable
+from typing import Mapping, Any, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+# the number of delivered events, the last sequence number, and
+# the result of a submission that is not claimed (None if claimed)
+ClaimResult = Tuple[int, Optional[str], Optional[bool]]
+# a submission ID, the number of delivered events, the last sequence number
+Checkpoint = Tuple[UUID, int, Optional[str]]
 
 
 class QueueClient(ABC):
     @abstractmethod
-    def get_messages(self) -> Iterable[Mapping[str, Any]]:
+    async def get_messages(self) -> Iterable[Mapping[str, Any]]:
+        pass
+
+    @abstractmethod
+    async def delete_message(self, id_):
+        pass
+
+    @abstractmethod
+    async def delete_messages(self, ids: Sequence[str]) -> Mapping[str, str]:
+        pass
+
+    @abstractmethod
+    async def change_visibility(self, ids: Sequence[str], visibility_timeout: int) -> Mapping[str, str]:
+        pass
+
+    def get_pollers(self) -> Optional[int]:
+        """
+        Returns the number of concurrent receive requests the client wants,
+        or None if it does not tune them.
+        """
+        return None
+
+    @abstractmethod
+    def get_receive_options(self) -> Tuple[int, int]:
+        """
+        Returns the maximal number of messages a receive returns and
+        the time it waits for messages.
+        """
         pass
 
     @abstractmethod
-    def delete_message(self, id_):
+    def set_receive_options(self, max_message_number: int, wait_time: int, max_pollers: int):
+        """
+        Changes the receive options at runtime. A client tuning the pollers
+        keeps up to `max_pollers` of them active. Raises ValueError without
+        changing anything if the options exceed the limits of the source.
+        """
         pass
 
     @abstractmethod
     def get_deletion_id(self, message):
         pass
 
+    @abstractmethod
+    def get_submission_body(self, message) -> bytes:
+        pass
+
     @abstractmethod
     def get_submission_from_message(self, message):
         pass
+
+
+class SubmissionStateStore(ABC):
+    @abstractmethod
+    async def claim(self, submissions: Sequence[Tuple[UUID, int]]) -> List[ClaimResult]:
+        pass
+
+    @abstractmethod
+    async def save_checkpoints(self, checkpoints: Sequence[Checkpoint]):
+        pass
+
+    @abstractmethod
+    def release_leases(self, submission_ids: Sequence[UUID]):
+        """
+        Stops renewing the leases of submissions whose publishing failed,
+        so other workers take them over when the leases expire.
+        """
+        pass
@@ -1,48 +1,59 @@
 import logging
-from typing import Union
+from typing import List, Tuple, Mapping, Any
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 from app.worker.infrastructure.clients.exceptions import KinesisClientException
-from app.worker.infrastructure.clients.session_manager import AWSSessionManager
 
 logger = logging.getLogger(__name__)
 
+# API errors and transport errors, e.g. EndpointConnectionError or ReadTimeoutError
+KINESIS_ERRORS = (ClientError, BotoCoreError)
 
-class KinesisClient:
-    def __init__(self, endpoint_url):
-        self.endpoint_url = endpoint_url
 
-    def _get_async_client(self):
-        return AWSSessionManager("kinesis", endpoint_url=self.endpoint_url)
+class KinesisClient:
+    def __init__(self, client):
+        self.client = client
 
-    async def put_record(
+    async def put_records(
             self,
             stream_name: str,
-            data: bytes,
-            partition_key: str,
-            sequence_number: Union[str, None],
-    ) -> str:
-        logger.debug(f"put record: {data}: {partition_key}: {sequence_number}")
-        kwargs = {
-            "StreamName": stream_name,
-            "Data": data,
-            "PartitionKey": partition_key,
-        }
-        if sequence_number is not None:
-            kwargs["SequenceNumberForOrdering"] = sequence_number
-
-        async with self._get_async_client() as client:
-            try:
-                response = await client.put_record(**kwargs)
-            except ClientError as ex:
-                logger.warning(
-                    f"Error while sending an event to the stream {stream_name}: "
-                    f"the partition key: {partition_key}: "
-                    f"the sequence number: {sequence_number}: "
-                    f"data: {data}: exception: {ex}"
-                )
-                raise KinesisClientException from ex
-
-        logger.debug(f"put record SUCCESS: {data}: {partition_key}: {sequence_number}")
-        return response["SequenceNumber"]
+            records: List[Tuple[bytes, str]],
+    ) -> List[Mapping[str, Any]]:
+        logger.debug(f"put {len(records)} records to the stream {stream_name}")
+        entries = [
+            {"Data": data, "PartitionKey": partition_key}
+            for data, partition_key in records
+        ]
+        try:
+            response = await self.client.put_records(StreamName=stream_name, Records=entries)
+        except KINESIS_ERRORS as ex:
+            logger.warning(
+                f"Error while sending {len(records)} records to the stream {stream_name}: "
+                f"exception: {ex}"
+            )
+            raise KinesisClientException from ex
+
+        logger.debug(
+            f"put records SUCCESS: {len(records)} records, "
+            f"failed: {response.get('FailedRecordCount', 0)}"
+        )
+        return response["Records"]
+
+    async def list_shards(self, stream_name: str) -> List[Mapping[str, Any]]:
+        shards: List[Mapping[str, Any]] = []
+        kwargs = {"StreamName": stream_name}
+        try:
+            while True:
+                response = await self.client.list_shards(**kwargs)
+                shards.extend(response["Shards"])
+                if not response.get("NextToken"):
+                    break
+                # the stream name must not be passed with a token
+                kwargs = {"NextToken": response["NextToken"]}
+        except KINESIS_ERRORS as ex:
+            logger.warning(f"Error while listing shards of the stream {stream_name}: exception: {ex}")
+            raise KinesisClientException from ex
+
+        logger.debug(f"list shards SUCCESS: {len(shards)} shards of the stream {stream_name}")
+        return shards
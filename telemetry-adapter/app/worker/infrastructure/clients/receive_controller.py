@@ -0,0 +1,116 @@
+import math
+import time
+from typing import Optional
+
+from app.metrics import registry
+
+# the options of a process, the maximum of the processes is reported
+receive_batch_size = registry.gauge(
+    "sqs_receive_batch_size", "MaxNumberOfMessages of receive requests", "max"
+)
+receive_wait_time = registry.gauge(
+    "sqs_receive_wait_time_seconds", "WaitTimeSeconds of receive requests", "max"
+)
+# the pollers of all processes are added up
+active_pollers = registry.gauge("sqs_active_pollers", "Pollers receiving messages")
+# every process reads the depth of the same queue
+queue_depth = registry.gauge(
+    "sqs_approximate_number_of_messages", "ApproximateNumberOfMessages of the queue", "max"
+)
+
+
+class ReceiveController:
+    """
+    Tunes receive requests to the queue depth, the number of messages
+    in recent batches and the processing latency (from receiving a message
+    to its deletion).
+
+    A backlog gets full batches without waiting and more pollers, an idle
+    queue gets long polling and the minimal number of pollers. When the
+    latency exceeds `target_latency` the pipeline is the bottleneck,
+    so pollers are removed instead of added.
+    """
+    def __init__(
+        self,
+        min_batch_size: int,
+        max_batch_size: int,
+        min_wait_time: int,
+        max_wait_time: int,
+        min_pollers: int,
+        max_pollers: int,
+        target_latency: float,
+        adjust_interval: float = 5.0,
+        smoothing: float = 0.2,
+    ):
+        self.min_batch_size = min(min_batch_size, max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.min_wait_time = min(min_wait_time, max_wait_time)
+        self.max_wait_time = max_wait_time
+        self.min_pollers = min(min_pollers, max_pollers)
+        self.max_pollers = max_pollers
+        self.target_latency = target_latency
+        self.adjust_interval = adjust_interval
+        self.smoothing = smoothing
+        self.batch_size = max_batch_size
+        self.wait_time = max_wait_time
+        self.pollers = self.min_pollers
+        self.queue_depth: Optional[int] = None
+        self.fill_ratio = 0.0
+        self.latency = 0.0
+        self._adjusted_at = time.monotonic()
+        self._export()
+
+    def set_limits(self, max_batch_size: int, max_wait_time: int, max_pollers: int):
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min(self.min_batch_size, max_batch_size)
+        self.max_wait_time = max_wait_time
+        self.min_wait_time = min(self.min_wait_time, max_wait_time)
+        self.max_pollers = max_pollers
+        self.min_pollers = min(self.min_pollers, max_pollers)
+        self.batch_size = min(self.batch_size, max_batch_size)
+        self.wait_time = min(self.wait_time, max_wait_time)
+        self.pollers = min(self.pollers, max_pollers)
+        self._export()
+
+    def is_adjustment_due(self) -> bool:
+        return time.monotonic() - self._adjusted_at >= self.adjust_interval
+
+    def on_queue_depth(self, depth: int):
+        self.queue_depth = depth
+        queue_depth.set(depth)
+
+    def on_receive(self, messages_number: int):
+        fill_ratio = messages_number / self.batch_size
+        self.fill_ratio += self.smoothing * (fill_ratio - self.fill_ratio)
+
+    def on_processed(self, latency: float):
+        self.latency += self.smoothing * (latency - self.latency)
+
+    def adjust(self):
+        self._adjusted_at = time.monotonic()
+        depth = self.queue_depth or 0
+        if self.latency > self.target_latency:
+            self.pollers = max(self.min_pollers, self.pollers - 1)
+            self.batch_size = self.max_batch_size
+            self.wait_time = self.min_wait_time
+        elif depth >= self.pollers * self.max_batch_size or self.fill_ratio > 0.8:
+            self.pollers = min(self.max_pollers, self.pollers + 1)
+            self.batch_size = self.max_batch_size
+            self.wait_time = self.min_wait_time
+        elif depth == 0 and self.fill_ratio < 0.2:
+            self.pollers = self.min_pollers
+            self.batch_size = self.max_batch_size
+            self.wait_time = self.max_wait_time
+        else:
+            # share a small backlog between pollers and other workers
+            self.batch_size = min(
+                self.max_batch_size,
+                max(self.min_batch_size, math.ceil(depth / self.pollers)),
+            )
+            self.wait_time = self.max_wait_time if self.fill_ratio < 0.5 else self.min_wait_time
+        self._export()
+
+    def _export(self):
+        receive_batch_size.set(self.batch_size)
+        receive_wait_time.set(self.wait_time)
+        active_pollers.set(self.pollers)
@@ -1,9 +1,29 @@
 from contextlib import AsyncExitStack
 
+from aiobotocore.config import AioConfig
 from aiobotocore.session import AioSession
 
 
+def get_client_config(
+    max_pool_connections: int,
+    connect_timeout: float,
+    read_timeout: float,
+    keepalive_timeout: float,
+    tcp_keepalive: bool,
+) -> AioConfig:
+    return AioConfig(
+        max_pool_connections=max_pool_connections,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        tcp_keepalive=tcp_keepalive,
+        connector_args={"keepalive_timeout": keepalive_timeout},
+    )
+
+
 class AWSSessionManager:
+    """
+    Opens one client and its connection pool for the lifespan of the application.
+    """
     def __init__(self, resource_name, **kwargs):
         self._exit_stack = AsyncExitStack()
         self._client = None
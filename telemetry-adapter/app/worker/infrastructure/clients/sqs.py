@@ -1,79 +1,236 @@
-import base64
+import asyncio
+import binascii
 import hashlib
 import json
 import logging
+import time
 import traceback
-from typing import Mapping, Any, Iterable
+from collections import OrderedDict
+from typing import Mapping, Any, Iterable, Optional, Sequence, Tuple
 
-import boto3
 import botocore.exceptions
 
+from app.metrics import registry
 from app.worker.infrastructure.clients.interfaces import QueueClient
+from app.worker.infrastructure.clients.receive_controller import ReceiveController
 from app.worker.infrastructure.clients.exceptions import (
     QueueClientReceivingException, QueueClientUnexpectedMessage
 )
-from app.worker.infrastructure.clients.session_manager import AWSSessionManager
 
 logger = logging.getLogger(__name__)
 
+# batch requests accept up to 10 entries
+MAX_BATCH_ENTRIES = 10
+# API errors and transport errors, e.g. EndpointConnectionError or ReadTimeoutError
+SQS_ERRORS = (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError)
+# the limits of ReceiveMessage
+MAX_RECEIVE_MESSAGES = 10
+MAX_WAIT_TIME = 20
+# receipt handles remembered to measure the processing latency
+MAX_TRACKED_RECEIPTS = 10_000
+
+request_duration = registry.histogram("sqs_request_duration_seconds", "SQS requests")
+request_errors = registry.counter("sqs_request_errors_total", "Failed SQS requests")
+received_batch_size = registry.histogram(
+    "sqs_received_batch_size", "Messages received by a request", (0, 1, 2, 5, 10)
+)
+
 
 class SQSClient(QueueClient):
     def __init__(
             self,
+            client,
             queue_url,
-            endpoint_url,
             max_message_number,
             visibility_timeout,
-            wait_time
+            wait_time,
+            receive_controller: Optional[ReceiveController] = None,
     ):
-        self.sqs_client = boto3.client("sqs", endpoint_url=endpoint_url)
-        self.endpoint_url = endpoint_url
+        self.client = client
         self.queue_url = queue_url
         self.max_message_number = max_message_number
         self.visibility_timeout = visibility_timeout
         self.wait_time = wait_time
+        self.receive_controller = receive_controller
+        # {receipt handle: received at}
+        self._received_at: OrderedDict[str, float] = OrderedDict()
+        # one poller adjusts receiving, the others keep the current options
+        self._adjusting = asyncio.Lock()
 
-    def _get_async_client(self):
-        return AWSSessionManager("sqs", endpoint_url=self.endpoint_url)
-
-    def get_messages(self) -> Iterable[Mapping[str, Any]]:
+    async def get_messages(self) -> Iterable[Mapping[str, Any]]:
         logger.debug(f"get messages from {self.queue_url}")
+        max_message_number, wait_time = self.max_message_number, self.wait_time
+        controller = self.receive_controller
+        if controller is not None:
+            if controller.is_adjustment_due() and not self._adjusting.locked():
+                async with self._adjusting:
+                    await self._adjust_receiving()
+            max_message_number, wait_time = controller.batch_size, controller.wait_time
+        started_at = time.perf_counter()
         try:
-            response = self.sqs_client.receive_message(
+            response = await self.client.receive_message(
                 QueueUrl=self.queue_url,
                 AttributeNames=['All'],
-                MaxNumberOfMessages=self.max_message_number,
+                MaxNumberOfMessages=max_message_number,
                 VisibilityTimeout=self.visibility_timeout,
-                WaitTimeSeconds=self.wait_time
+                WaitTimeSeconds=wait_time
             )
-        except botocore.exceptions.ClientError as ex:
+        except SQS_ERRORS as ex:
+            request_errors.inc(operation="receive")
             logger.warning(f"Error while retrieving messages: {self.queue_url}: {ex}")
             raise QueueClientReceivingException from ex
+        request_duration.observe(time.perf_counter() - started_at, operation="receive")
 
         messages = response.get("Messages", [])
+        received_batch_size.observe(len(messages))
+        if controller is not None:
+            controller.on_receive(len(messages))
+            now = time.monotonic()
+            for message in messages:
+                self._received_at[message["ReceiptHandle"]] = now
+            while len(self._received_at) > MAX_TRACKED_RECEIPTS:
+                self._received_at.popitem(last=False)
         return messages
 
+    def get_pollers(self) -> Optional[int]:
+        if self.receive_controller is None:
+            return None
+        return self.receive_controller.pollers
+
+    def get_receive_options(self) -> Tuple[int, int]:
+        return self.max_message_number, self.wait_time
+
+    def set_receive_options(self, max_message_number: int, wait_time: int, max_pollers: int):
+        check_receive_options(max_message_number, wait_time)
+        self.max_message_number = max_message_number
+        self.wait_time = wait_time
+        if self.receive_controller is not None:
+            # the controller tunes receiving within the new limits
+            self.receive_controller.set_limits(max_message_number, wait_time, max_pollers)
+
+    async def get_queue_depth(self) -> int:
+        try:
+            response = await self.client.get_queue_attributes(
+                QueueUrl=self.queue_url,
+                AttributeNames=["ApproximateNumberOfMessages"]
+            )
+        except SQS_ERRORS as ex:
+            logger.warning(f"Error while retrieving the queue attributes: {self.queue_url}: {ex}")
+            raise QueueClientReceivingException from ex
+        return int(response["Attributes"]["ApproximateNumberOfMessages"])
+
+    async def _adjust_receiving(self):
+        controller = self.receive_controller
+        try:
+            controller.on_queue_depth(await self.get_queue_depth())
+        except QueueClientReceivingException:
+            pass
+        controller.adjust()
+        logger.debug(
+            f"receive up to {controller.batch_size} messages, wait {controller.wait_time}s, "
+            f"pollers: {controller.pollers}"
+        )
+
     async def delete_message(self, receipt_handle: str):
         logger.debug(f"delete the message {receipt_handle}")
-        async with self._get_async_client() as client:
-            try:
-                await client.delete_message(
-                    QueueUrl=self.queue_url,
-                    ReceiptHandle=receipt_handle
-                )
-            except botocore.exceptions.ClientError as ex:
-                err = f"Error while deleting the message {receipt_handle}: {self.queue_url}: {ex}"
-                logger.warning(err)
-                raise QueueClientReceivingException from ex
-            except Exception as ex:
-                logger.warning(f"a deletion error {ex}: {traceback.format_exc()}")
-                raise ex
-            logger.debug(f"the successful deletion: {receipt_handle}")
+        try:
+            await self.client.delete_message(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=receipt_handle
+            )
+        except SQS_ERRORS as ex:
+            err = f"Error while deleting the message {receipt_handle}: {self.queue_url}: {ex}"
+            logger.warning(err)
+            raise QueueClientReceivingException from ex
+        except Exception as ex:
+            logger.warning(f"a deletion error {ex}: {traceback.format_exc()}")
+            raise ex
+        logger.debug(f"the successful deletion: {receipt_handle}")
+
+    async def delete_messages(self, receipt_handles: Sequence[str]) -> Mapping[str, str]:
+        logger.debug(f"delete the messages {receipt_handles}")
+        entries = [
+            {"Id": str(i), "ReceiptHandle": receipt_handle}
+            for i, receipt_handle in enumerate(receipt_handles)
+        ]
+        started_at = time.perf_counter()
+        try:
+            response = await self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=entries
+            )
+        except SQS_ERRORS as ex:
+            request_errors.inc(operation="delete")
+            logger.warning(f"Error while deleting {len(entries)} messages: {self.queue_url}: {ex}")
+            raise QueueClientReceivingException from ex
+
+        request_duration.observe(time.perf_counter() - started_at, operation="delete")
+        failed = {
+            receipt_handles[int(entry["Id"])]: f"{entry['Code']}: {entry.get('Message')}"
+            for entry in response.get("Failed", [])
+        }
+        for receipt_handle, error in failed.items():
+            logger.warning(f"Error while deleting the message {receipt_handle}: {self.queue_url}: {error}")
+        if self.receive_controller is not None:
+            now = time.monotonic()
+            for receipt_handle in receipt_handles:
+                received_at = self._received_at.pop(receipt_handle, None)
+                if received_at is not None and receipt_handle not in failed:
+                    self.receive_controller.on_processed(now - received_at)
+        logger.debug(f"the successful deletion: {len(entries) - len(failed)} messages")
+        return failed
+
+    async def change_visibility(
+        self, receipt_handles: Sequence[str], visibility_timeout: int
+    ) -> Mapping[str, str]:
+        logger.debug(f"change the visibility of {len(receipt_handles)} messages to {visibility_timeout}s")
+        failed = {}
+        responses = await asyncio.gather(*(
+            self._change_visibility_batch(
+                receipt_handles[i:i + MAX_BATCH_ENTRIES], visibility_timeout
+            )
+            for i in range(0, len(receipt_handles), MAX_BATCH_ENTRIES)
+        ))
+        for response in responses:
+            failed.update(response)
+        return failed
+
+    async def _change_visibility_batch(
+        self, receipt_handles: Sequence[str], visibility_timeout: int
+    ) -> Mapping[str, str]:
+        entries = [
+            {"Id": str(i), "ReceiptHandle": receipt_handle, "VisibilityTimeout": visibility_timeout}
+            for i, receipt_handle in enumerate(receipt_handles)
+        ]
+        started_at = time.perf_counter()
+        try:
+            response = await self.client.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=entries
+            )
+        except SQS_ERRORS as ex:
+            request_errors.inc(operation="change_visibility")
+            logger.warning(
+                f"Error while changing the visibility of {len(entries)} messages: {self.queue_url}: {ex}"
+            )
+            raise QueueClientReceivingException from ex
+        request_duration.observe(time.perf_counter() - started_at, operation="change_visibility")
+        if visibility_timeout == 0:
+            for receipt_handle in receipt_handles:
+                self._received_at.pop(receipt_handle, None)
+
+        failed = {
+            receipt_handles[int(entry["Id"])]: f"{entry['Code']}: {entry.get('Message')}"
+            for entry in response.get("Failed", [])
+        }
+        for receipt_handle, error in failed.items():
+            logger.debug(f"Error while changing the visibility of {receipt_handle}: {error}")
+        return failed
 
     def get_deletion_id(self, message: Mapping[str, Any]) -> str:
         return message["ReceiptHandle"]
 
-    def get_submission_from_message(self, message: Mapping[str, Any]) -> Mapping[str, Any]:
+    def get_submission_body(self, message: Mapping[str, Any]) -> bytes:
         body = message.get("Body")
         received_body_hash = message.get("MD5OfBody")
         if body is None or received_body_hash is None:
@@ -81,7 +238,8 @@ class SQSClient(QueueClient):
             logger.warning(err_msg)
             raise QueueClientUnexpectedMessage(msg=err_msg)
 
-        calculated_body_hash = hashlib.md5(str.encode(body)).hexdigest()
+        encoded_body = body.encode()
+        calculated_body_hash = hashlib.md5(encoded_body).hexdigest()
         if received_body_hash != calculated_body_hash:
             err_msg = (
                 f"The invalid body hash: {received_body_hash}. "
@@ -90,7 +248,27 @@ class SQSClient(QueueClient):
             logger.warning(err_msg)
             raise QueueClientUnexpectedMessage(msg=err_msg)
 
-        decoded_body = base64.standard_b64decode(body)
-        submission = json.loads(decoded_body)
+        try:
+            decoded_body = binascii.a2b_base64(encoded_body)
+        except binascii.Error as ex:
+            err_msg = f"The invalid base64 body: {ex}. Message: {message}"
+            logger.warning(err_msg)
+            raise QueueClientUnexpectedMessage(msg=err_msg)
         logger.debug(f"the decoded message body: {decoded_body}")
-        return submission
+        return decoded_body
+
+    def get_submission_from_message(self, message: Mapping[str, Any]) -> Mapping[str, Any]:
+        decoded_body = self.get_submission_body(message)
+        try:
+            return json.loads(decoded_body)
+        except ValueError as ex:
+            err_msg = f"The invalid JSON body: {ex}. Message: {message}"
+            logger.warning(err_msg)
+            raise QueueClientUnexpectedMessage(msg=err_msg)
+
+
+def check_receive_options(max_message_number: int, wait_time: int):
+    if not 1 <= max_message_number <= MAX_RECEIVE_MESSAGES:
+        raise ValueError(f"SQS returns from 1 to {MAX_RECEIVE_MESSAGES} messages by request")
+    if not 0 <= wait_time <= MAX_WAIT_TIME:
+        raise ValueError(f"SQS waits for messages from 0 to {MAX_WAIT_TIME} seconds")
@@ -0,0 +1,315 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime, UTC
+from enum import Enum
+from typing import Dict, List, Optional, Sequence, Tuple
+from uuid import UUID, uuid4
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+
+from app.metrics import registry
+from app.worker.infrastructure.clients.exceptions import SubmissionStoreException
+from app.worker.infrastructure.clients.interfaces import (
+    Checkpoint, ClaimResult, SubmissionStateStore
+)
+
+logger = logging.getLogger(__name__)
+
+query_duration = registry.histogram("db_query_duration_seconds", "Submission state queries")
+query_errors = registry.counter("db_query_errors_total", "Failed submission state queries")
+active_leases = registry.gauge("submission_leases", "Submissions leased by the worker")
+lease_renewals = registry.counter("submission_lease_renewals_total", "Renewed submission leases")
+lease_takeovers = registry.counter(
+    "submission_lease_takeovers_total", "Claims of submissions whose leases expired"
+)
+lost_leases = registry.counter(
+    "submission_leases_lost_total", "Leases taken over by other workers before the checkpoint"
+)
+
+
+class StatusEnum(Enum):
+    pending = "pending"
+    processed = "processed"
+
+
+# The table is partitioned by created_at, so its primary key can not make
+# a submission ID unique. The claim locks the IDs of a batch in a fixed order
+# until the end of its transaction, and the next statement sees the rows
+# committed by concurrent claims of the same IDs.
+LOCK_SUBMISSIONS = """
+SELECT pg_advisory_xact_lock(hashtextextended(id::text, 0))
+FROM (SELECT id FROM unnest(%(ids)s::uuid[]) AS t(id) ORDER BY id) AS ordered
+"""
+
+# Claims new submissions, resumes processed submissions with undelivered
+# events and takes over expired leases in one statement. A claimed
+# submission is leased by the worker with a new fencing token. Leases are
+# timed by the DB clock, which is the same for all workers.
+# The final SELECT reads the snapshot taken before the INSERT and
+# the UPDATE, so it returns the state of submissions that were not claimed.
+CLAIM_SUBMISSIONS = """
+WITH input AS (
+    SELECT * FROM unnest(%(ids)s::uuid[], %(event_numbers)s::integer[]) AS t(id, event_number)
+), stored AS (
+    SELECT s.id, s.created_at, s.status, s.number_of_delivered_events, s.sequence_number, s.lease_expires_at
+    FROM submissions AS s JOIN input ON input.id = s.id
+), resumed AS (
+    UPDATE submissions AS s SET
+        status = 'pending',
+        owner_id = %(owner_id)s,
+        lease_expires_at = statement_timestamp() + %(lease_ttl)s * interval '1 second',
+        fencing_token = s.fencing_token + 1,
+        updated_at = %(now)s
+    FROM stored JOIN input ON input.id = stored.id
+    WHERE s.id = stored.id AND s.created_at = stored.created_at AND (
+        stored.status = 'processed' AND stored.number_of_delivered_events < input.event_number
+        OR stored.status = 'pending' AND (
+            stored.lease_expires_at IS NULL OR stored.lease_expires_at < statement_timestamp()
+        )
+    )
+    RETURNING s.id, s.number_of_delivered_events, s.sequence_number, s.fencing_token,
+        stored.status = 'pending' AS is_takeover
+), inserted AS (
+    INSERT INTO submissions AS s (
+        id, status, number_of_delivered_events, created_at, owner_id, lease_expires_at, fencing_token
+    )
+    SELECT
+        id, 'pending', 0, %(now)s, %(owner_id)s,
+        statement_timestamp() + %(lease_ttl)s * interval '1 second', 1
+    FROM input
+    WHERE NOT EXISTS (SELECT 1 FROM stored WHERE stored.id = input.id)
+    RETURNING s.id, s.number_of_delivered_events, s.sequence_number, s.fencing_token, false
+), claimed AS (
+    SELECT * FROM resumed UNION ALL SELECT * FROM inserted
+)
+SELECT
+    input.id,
+    input.event_number,
+    claimed.id IS NOT NULL,
+    claimed.number_of_delivered_events,
+    claimed.sequence_number,
+    claimed.fencing_token,
+    claimed.is_takeover,
+    stored.status,
+    stored.number_of_delivered_events
+FROM input
+LEFT JOIN claimed ON claimed.id = input.id
+LEFT JOIN stored ON stored.id = input.id
+"""
+
+# Saves the progress and ends the leases of the submissions whose fencing
+# tokens are not changed by a takeover
+SAVE_CHECKPOINTS = """
+UPDATE submissions SET
+    number_of_delivered_events = progress.delivered,
+    sequence_number = progress.sequence_number,
+    status = 'processed',
+    owner_id = NULL,
+    lease_expires_at = NULL,
+    updated_at = %(now)s
+FROM unnest(
+    %(ids)s::uuid[], %(delivered)s::integer[], %(sequence_numbers)s::text[], %(fencing_tokens)s::bigint[]
+) AS progress(id, delivered, sequence_number, fencing_token)
+WHERE submissions.id = progress.id AND submissions.fencing_token = progress.fencing_token
+RETURNING submissions.id
+"""
+
+RENEW_LEASES = """
+UPDATE submissions SET lease_expires_at = statement_timestamp() + %(lease_ttl)s * interval '1 second'
+FROM unnest(%(ids)s::uuid[], %(fencing_tokens)s::bigint[]) AS lease(id, fencing_token)
+WHERE submissions.id = lease.id AND submissions.fencing_token = lease.fencing_token
+    AND submissions.status = 'pending'
+RETURNING submissions.id
+"""
+
+
+class PostgresSubmissionStore(SubmissionStateStore):
+    """
+    Leases claimed submissions to the worker for `lease_ttl` seconds and
+    renews the leases until their checkpoints, so a submission of a crashed
+    worker is taken over after its lease expires. A takeover increments the
+    fencing token of the submission, and the checkpoint of the previous owner
+    does not overwrite the progress of the new one. A lease is not renewed
+    longer than `max_lease_duration` seconds.
+    """
+    def __init__(
+        self,
+        pg_connection_pool: AsyncConnectionPool,
+        lease_ttl: float = 60.0,
+        max_lease_duration: float = 900.0,
+        owner_id: Optional[str] = None,
+    ):
+        self.connection_pool = pg_connection_pool
+        self.lease_ttl = lease_ttl
+        self.max_lease_duration = max_lease_duration
+        self.owner_id = owner_id or f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        # {submission ID: (fencing token, claimed at)}
+        self._leases: Dict[UUID, Tuple[int, float]] = {}
+        self._renewal: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self._renewal = asyncio.create_task(self._run_renewal())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._renewal is not None:
+            self._renewal.cancel()
+            await asyncio.gather(self._renewal, return_exceptions=True)
+            self._renewal = None
+
+    async def claim(self, submissions: Sequence[Tuple[UUID, int]]) -> List[ClaimResult]:
+        # a duplicate of a claimed submission in the same batch waits for the next delivery
+        results: List[ClaimResult] = [(0, None, False)] * len(submissions)
+        indexes: Dict[UUID, int] = {}
+        for i, (submission_id, _) in enumerate(submissions):
+            indexes.setdefault(submission_id, i)
+        if not indexes:
+            return results
+
+        ids = list(indexes)
+        event_numbers = [submissions[indexes[submission_id]][1] for submission_id in ids]
+        started_at = time.perf_counter()
+        try:
+            async with self.connection_pool.connection() as conn:
+                await conn.set_autocommit(True)
+                # the pipeline sends the lock and the claim together, so the claim takes
+                # three round trips: BEGIN, the two statements and COMMIT
+                async with conn.transaction(), conn.pipeline():
+                    await conn.execute(LOCK_SUBMISSIONS, {"ids": ids})
+                    cursor = await conn.execute(
+                        CLAIM_SUBMISSIONS,
+                        {
+                            "ids": ids,
+                            "event_numbers": event_numbers,
+                            "now": datetime.now(UTC),
+                            "owner_id": self.owner_id,
+                            "lease_ttl": self.lease_ttl,
+                        }
+                    )
+                rows = await cursor.fetchall()
+        except psycopg.Error as ex:
+            query_errors.inc(query="claim")
+            logger.warning(f"DB error while claiming {len(ids)} submissions: {ex}")
+            raise SubmissionStoreException from ex
+        query_duration.observe(time.perf_counter() - started_at, query="claim")
+
+        claimed_at = time.monotonic()
+        for row in rows:
+            (
+                submission_id, event_number, is_claimed, delivered, sequence_number,
+                fencing_token, is_takeover, status, stored_delivered
+            ) = row
+            i = indexes[submission_id]
+            if is_claimed:
+                results[i] = (delivered, sequence_number, None)
+                self._leases[submission_id] = (fencing_token, claimed_at)
+                if is_takeover:
+                    lease_takeovers.inc()
+                    logger.info(f"took over the expired lease of the submission {submission_id}")
+            elif status == StatusEnum.processed.value and stored_delivered >= event_number:
+                results[i] = (stored_delivered, None, True)
+            else:
+                logger.debug(f"the other worker is processing the submission {submission_id}")
+        active_leases.set(len(self._leases))
+        for i, (submission_id, _) in enumerate(submissions):
+            first_result = results[indexes[submission_id]]
+            if first_result[2] is True:
+                results[i] = first_result
+        return results
+
+    async def save_checkpoints(self, checkpoints: Sequence[Checkpoint]):
+        if not checkpoints:
+            return
+        # a lease that is not ended by the checkpoint expires
+        fencing_tokens = [
+            self._leases.pop(submission_id, (0, 0.0))[0] for submission_id, _, _ in checkpoints
+        ]
+        active_leases.set(len(self._leases))
+        started_at = time.perf_counter()
+        try:
+            async with self.connection_pool.connection() as conn:
+                await conn.set_autocommit(True)
+                cursor = await conn.execute(
+                    SAVE_CHECKPOINTS,
+                    {
+                        "now": datetime.now(UTC),
+                        "ids": [submission_id for submission_id, _, _ in checkpoints],
+                        "delivered": [delivered for _, delivered, _ in checkpoints],
+                        "sequence_numbers": [sequence_number for _, _, sequence_number in checkpoints],
+                        "fencing_tokens": fencing_tokens,
+                    }
+                )
+                saved = {submission_id for submission_id, in await cursor.fetchall()}
+        except psycopg.Error as ex:
+            query_errors.inc(query="save_checkpoints")
+            logger.warning(f"DB error while saving checkpoints of {len(checkpoints)} submissions: {ex}")
+            raise SubmissionStoreException from ex
+        query_duration.observe(time.perf_counter() - started_at, query="save_checkpoints")
+        for submission_id, _, _ in checkpoints:
+            if submission_id not in saved:
+                lost_leases.inc()
+                logger.warning(f"the lease of the submission {submission_id} is taken over, the checkpoint is skipped")
+
+    def release_leases(self, submission_ids: Sequence[UUID]):
+        for submission_id in submission_ids:
+            self._leases.pop(submission_id, None)
+        active_leases.set(len(self._leases))
+
+    async def renew_leases(self):
+        now = time.monotonic()
+        for submission_id, (_, claimed_at) in list(self._leases.items()):
+            if now - claimed_at >= self.max_lease_duration:
+                logger.warning(f"stop renewing the lease of the submission {submission_id}")
+                del self._leases[submission_id]
+        if not self._leases:
+            active_leases.set(0)
+            return
+        leases = dict(self._leases)
+        started_at = time.perf_counter()
+        try:
+            async with self.connection_pool.connection() as conn:
+                await conn.set_autocommit(True)
+                cursor = await conn.execute(
+                    RENEW_LEASES,
+                    {
+                        "ids": list(leases),
+                        "fencing_tokens": [fencing_token for fencing_token, _ in leases.values()],
+                        "lease_ttl": self.lease_ttl,
+                    }
+                )
+                renewed = {submission_id for submission_id, in await cursor.fetchall()}
+        except psycopg.Error as ex:
+            query_errors.inc(query="renew_leases")
+            logger.warning(f"DB error while renewing {len(leases)} leases: {ex}")
+            raise SubmissionStoreException from ex
+        query_duration.observe(time.perf_counter() - started_at, query="renew_leases")
+        lease_renewals.inc(len(renewed))
+        for submission_id, lease in leases.items():
+            # the lease may be ended by a checkpoint or claimed again during the renewal
+            if submission_id not in renewed and self._leases.get(submission_id) == lease:
+                del self._leases[submission_id]
+                lost_leases.inc()
+                logger.warning(f"the lease of the submission {submission_id} is taken over")
+        active_leases.set(len(self._leases))
+
+    async def _run_renewal(self):
+        while True:
+            # a lease is renewed twice before it expires
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self.renew_leases()
+            except SubmissionStoreException:
+                pass
+
+
+def export_pool_stats(pool: AsyncConnectionPool):
+    """
+    Copies the connection pool stats to gauges, e.g. db_pool_requests_waiting.
+    The counters of the pool (requests_num, usage_ms, ...) grow since its start.
+    """
+    for name, value in pool.get_stats().items():
+        registry.gauge(f"db_pool_{name}", f"AsyncConnectionPool {name}").set(value)
@@ -0,0 +1,144 @@
+import struct
+import zlib
+from typing import Mapping, Optional, Sequence
+
+from app.metrics import registry
+from app.worker.infrastructure.serialization import RECORD_MAGIC
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSED_RECORD = 0x03
+COMPRESSED_RECORD_VERSION = 1
+
+ZLIB = 1
+ZSTD = 2
+ALGORITHMS = {"zlib": ZLIB, "zstd": ZSTD}
+
+# zlib can not refer to data farther than its 32 KiB window
+MAX_ZLIB_DICTIONARY_SIZE = 32 * 1024
+
+_COMPRESSED_RECORD_HEADER = bytes([RECORD_MAGIC, COMPRESSED_RECORD, COMPRESSED_RECORD_VERSION])
+# the algorithm and the dictionary ID
+_COMPRESSION = struct.Struct(">BI")
+
+raw_bytes = registry.counter(
+    "kinesis_record_raw_bytes_total", "Bytes of records before compression"
+)
+compressed_bytes = registry.counter(
+    "kinesis_record_compressed_bytes_total", "Bytes of records after compression"
+)
+
+
+def get_dictionary_id(dictionary: Optional[bytes]) -> int:
+    return zlib.crc32(dictionary) if dictionary else 0
+
+
+class RecordCompressor:
+    """
+    Compresses records, version 1 (big-endian):
+
+    header         3 bytes: 0xFE, 0x03 (a compressed record), 0x01 (the version)
+    algorithm      uint8: 1 - zlib (raw deflate), 2 - zstd
+    dictionary_id  uint32, CRC32 of the dictionary or 0 without a dictionary
+    data           the compressed record
+
+    A record is sent as it is when compression does not make it smaller.
+    """
+    def __init__(
+        self, algorithm: str, level: Optional[int] = None, dictionary: Optional[bytes] = None
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown compression algorithm: {algorithm}")
+        self.algorithm = ALGORITHMS[algorithm]
+        self.header = _COMPRESSED_RECORD_HEADER + _COMPRESSION.pack(
+            self.algorithm, get_dictionary_id(dictionary)
+        )
+        if self.algorithm == ZSTD:
+            if zstandard is None:
+                raise ValueError("zstd compression requires the zstandard package")
+            self._zstd = zstandard.ZstdCompressor(
+                level=3 if level is None else level,
+                dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None,
+                write_content_size=False,
+                write_checksum=False,
+            )
+        else:
+            if dictionary and len(dictionary) > MAX_ZLIB_DICTIONARY_SIZE:
+                dictionary = dictionary[-MAX_ZLIB_DICTIONARY_SIZE:]
+            # a primed compressor is copied for every record, so the dictionary
+            # is processed once
+            self._zlib = zlib.compressobj(
+                level=6 if level is None else level,
+                wbits=-15,
+                **({"zdict": dictionary} if dictionary else {}),
+            )
+
+    def compress(self, data: bytes) -> bytes:
+        if self.algorithm == ZSTD:
+            compressed = self._zstd.compress(data)
+        else:
+            compressor = self._zlib.copy()
+            compressed = compressor.compress(data) + compressor.flush()
+        raw_bytes.inc(len(data))
+        if len(self.header) + len(compressed) >= len(data):
+            compressed_bytes.inc(len(data))
+            return data
+        compressed_bytes.inc(len(self.header) + len(compressed))
+        return self.header + compressed
+
+
+def decompress(data: bytes, dictionaries: Optional[Mapping[int, bytes]] = None) -> bytes:
+    """
+    Restores a compressed record. The dictionaries are looked up by their
+    IDs. A record that is not compressed is returned as it is.
+    """
+    if data[:2] != _COMPRESSED_RECORD_HEADER[:2]:
+        return data
+    if data[2] != COMPRESSED_RECORD_VERSION:
+        raise ValueError(f"Unsupported compressed record version: {data[2]}")
+    algorithm, dictionary_id = _COMPRESSION.unpack_from(data, len(_COMPRESSED_RECORD_HEADER))
+    compressed = data[len(_COMPRESSED_RECORD_HEADER) + _COMPRESSION.size:]
+    dictionary = None
+    if dictionary_id:
+        dictionary = (dictionaries or {}).get(dictionary_id)
+        if dictionary is None:
+            raise ValueError(f"Unknown compression dictionary: {dictionary_id}")
+    if algorithm == ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd decompression requires the zstandard package")
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        )
+        return decompressor.decompressobj().decompress(compressed)
+    if algorithm == ZLIB:
+        if dictionary and len(dictionary) > MAX_ZLIB_DICTIONARY_SIZE:
+            dictionary = dictionary[-MAX_ZLIB_DICTIONARY_SIZE:]
+        decompressor = zlib.decompressobj(wbits=-15, **({"zdict": dictionary} if dictionary else {}))
+        return decompressor.decompress(compressed) + decompressor.flush()
+    raise ValueError(f"Unknown compression algorithm: {algorithm}")
+
+
+def build_dictionary(
+    samples: Sequence[bytes], algorithm: str, size: int = MAX_ZLIB_DICTIONARY_SIZE
+) -> bytes:
+    """
+    Builds a dictionary from sample records, e.g. events captured from
+    the stream.
+    """
+    if algorithm == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd dictionaries require the zstandard package")
+        return zstandard.train_dictionary(size, list(samples)).as_bytes()
+    # zlib finds matches closer to the end of a dictionary with shorter codes,
+    # so the samples fill the dictionary from the end
+    size = min(size, MAX_ZLIB_DICTIONARY_SIZE)
+    dictionary, dictionary_size = [], 0
+    for sample in samples:
+        if dictionary_size + len(sample) > size:
+            break
+        dictionary.append(sample)
+        dictionary_size += len(sample)
+    return b"".join(reversed(dictionary))
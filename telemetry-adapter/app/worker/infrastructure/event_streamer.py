@@ -1,192 +1,135 @@
+import asyncio
 from abc import ABC, abstractmethod
-from datetime import datetime, UTC
 import logging
-from enum import Enum
-from typing import Union, Optional, Tuple
-from uuid import uuid4
-
-import psycopg.errors
-from psycopg.rows import class_row
-from psycopg_pool import AsyncConnectionPool
-from pydantic import BaseModel, UUID4, AwareDatetime, NonNegativeInt
-
-from app.worker.infrastructure.clients.exceptions import KinesisClientException
-from app.worker.infrastructure.clients.kinesis import KinesisClient
-from app.worker.infrastructure.types import Submission, NewProcess, NetworkConnection
+import time
+from typing import Optional, Tuple, List, Sequence
+
+from app.worker.infrastructure.clients.exceptions import KinesisClientException, SubmissionStoreException
+from app.worker.infrastructure.clients.interfaces import SubmissionStateStore
+from app.worker.infrastructure.compression import RecordCompressor
+from app.worker.infrastructure.kinesis_batcher import RecordWriter
+from app.worker.infrastructure.serialization import (
+    Event, EventEncoder, JsonEventEncoder, aggregate_records
+)
+from app.worker.infrastructure.types import SubmissionData
+from app.worker.tracing import add_stage
 
 logger = logging.getLogger(__name__)
 
 
 class EventStreamer(ABC):
     @abstractmethod
-    def downstream_submission(self, submission: Submission):
+    def downstream_submissions(
+        self, submissions: Sequence[SubmissionData]
+    ) -> List[Optional[bool]]:
+        """
+        Returns True for a published submission, False for a failed one,
+        and None for a submission that can not be published now, e.g. another
+        worker is publishing it.
+        """
         pass
 
 
-class KinesisEvent(BaseModel):
-    id: UUID4
-    event_type: str
-    device_id: UUID4
-    processing_timestamp: AwareDatetime
-    event_details: Union[NewProcess, NetworkConnection]
-
-
-class StatusEnum(Enum):
-    pending = "pending"
-    processed = "processed"
-
-
-class StoredSubmission(BaseModel):
-    id: UUID4
-    status: StatusEnum
-    number_of_delivered_events: NonNegativeInt
-    sequence_number: Optional[str]
-    created_at: AwareDatetime
-    updated_at: Optional[AwareDatetime]
-    deleted_at: Optional[AwareDatetime]
-
-
 class KinesisStreamer(EventStreamer):
-    def __init__(self, kinesis_client: KinesisClient, pg_connection_pool: AsyncConnectionPool):
-        self.stream_name = "events"
-        self.kinesis_client = kinesis_client
-        self.connection_pool = pg_connection_pool
-
-    async def downstream_submission(self, submission: Submission) -> bool:
-        process_events = [("new_process", p) for p in submission.events.new_process]
-        connection_events = [("network_connection", p) for p in submission.events.network_connection]
-        all_events = process_events + connection_events
-
-        async with self.connection_pool.connection() as conn:
-            await conn.set_autocommit(True)
-            async with conn.cursor(row_factory=class_row(StoredSubmission)) as cur:
-                delivered_events_number, sequence_number, is_success = await self._get_current_submission_status(
-                    cur,
-                    submission.submission_id,
-                    len(all_events)
-                )
-                if is_success is not None:
-                    return is_success
-
-            logger.debug(f"downstream a submission {submission}")
-            events = []
-            for event_type, event_details in all_events[delivered_events_number:]:
-                event = KinesisEvent(
-                    id=uuid4(),
-                    event_type=event_type,
-                    device_id=submission.device_id,
-                    processing_timestamp=datetime.now(UTC),
-                    event_details=event_details
-                )
-                events.append(event)
-
-            is_success = False
-            for i, event in enumerate(events):
-                json_event = event.model_dump_json()
-                try:
-                    async with conn.transaction():
-                        sequence_number = await self._send_event(
-                            conn,
-                            delivered_events_number,
-                            sequence_number,
-                            submission.submission_id,
-                            json_event,
-                            event.device_id
-                        )
-                        if sequence_number is None:
-                            await conn.rollback()
-                            break
-
-                        # can not make it in "for ... else ..." because
-                        # if the last event was delivered, we want to delete
-                        #  the message from SQS even when DB commit fails
-                        if i == len(events) - 1:
-                            is_success = True
-                        delivered_events_number += 1
-                        logger.debug(f"receive a sequence number {sequence_number} for {json_event}")
-                except psycopg.OperationalError as ex:
-                    logger.warning(f"DB error while sending the event {event}: {ex}")
-                    break
-
-            await conn.execute(
-                "UPDATE submissions SET number_of_delivered_events=%s, sequence_number=%s, "
-                "status='processed', updated_at=%s WHERE id=%s",
-                (
-                    delivered_events_number,
-                    sequence_number,
-                    datetime.now(UTC),
-                    submission.submission_id
-                )
+    def __init__(
+        self,
+        batcher: RecordWriter,
+        state_store: SubmissionStateStore,
+        encoder: Optional[EventEncoder] = None,
+        aggregation_max_bytes: Optional[int] = None,
+        compressor: Optional[RecordCompressor] = None,
+    ):
+        self.batcher = batcher
+        self.state_store = state_store
+        self.encoder = encoder or JsonEventEncoder()
+        self.aggregation_max_bytes = aggregation_max_bytes
+        self.compressor = compressor
+
+    async def downstream_submissions(
+        self, submissions: Sequence[SubmissionData]
+    ) -> List[Optional[bool]]:
+        started_at = time.perf_counter()
+        try:
+            statuses = await self.state_store.claim(
+                [(s["submission_id"], len(self._get_events(s))) for s in submissions]
+            )
+        except SubmissionStoreException:
+            return [None] * len(submissions)
+        claim_duration = time.perf_counter() - started_at
+        for submission in submissions:
+            add_stage(submission["submission_id"], "claim", claim_duration)
+
+        results: List[Optional[bool]] = []
+        claimed_indexes, publications = [], []
+        for i, (submission, status) in enumerate(zip(submissions, statuses)):
+            delivered_events_number, sequence_number, is_success = status
+            if is_success is not None:
+                # a submission that is not completed is claimed by another worker
+                results.append(is_success or None)
+                continue
+            results.append(None)
+            claimed_indexes.append(i)
+            publications.append(
+                self._publish_submission(submission, delivered_events_number, sequence_number)
             )
 
-        return is_success
+        try:
+            progress = await asyncio.gather(*publications)
+            for i, (_, _, is_success) in zip(claimed_indexes, progress):
+                results[i] = is_success
+            # the last events are delivered, so we want to delete the messages
+            # from SQS even when the checkpoint fails
+            started_at = time.perf_counter()
+            try:
+                await self.state_store.save_checkpoints([
+                    (submissions[i]["submission_id"], delivered_events_number, sequence_number)
+                    for i, (delivered_events_number, sequence_number, _) in zip(claimed_indexes, progress)
+                ])
+            except SubmissionStoreException:
+                pass
+        finally:
+            # the checkpoint ends the leases; after any other failure they expire
+            # instead of being renewed up to the maximal lease duration
+            self.state_store.release_leases([submissions[i]["submission_id"] for i in claimed_indexes])
+        checkpoint_duration = time.perf_counter() - started_at
+        for i in claimed_indexes:
+            add_stage(submissions[i]["submission_id"], "checkpoint", checkpoint_duration)
+        return results
 
     @staticmethod
-    async def _get_current_submission_status(
-        cursor,
-        submission_id,
-        event_number,
-    ) -> Tuple[int, Optional[str], Optional[bool]]:
-        delivered_events_number = 0
-        sequence_number = None
-
-        await cursor.execute(
-            "SELECT * FROM submissions WHERE id = %s",
-            (submission_id,)
-        )
-        stored_submission = await cursor.fetchone()
-        if stored_submission:
-            logger.debug(f"query_result {stored_submission}")
-            if stored_submission.status == StatusEnum.pending.value:
-                return delivered_events_number, sequence_number, False
-            if stored_submission.number_of_delivered_events == event_number:
-                return delivered_events_number, sequence_number, True
-            delivered_events_number = stored_submission.number_of_delivered_events
-            sequence_number = stored_submission.sequence_number
-            cursor.execute(
-                "UPDATE submissions SET status='pending' updated_at=%s "
-                "WHERE id=%s AND status='processed' AND delivered_events_number=%s",
-                (datetime.now(UTC), submission_id, delivered_events_number)
-            )
-            # another worker is processing an event
-            if cursor.rowcount == 0:
-                return delivered_events_number, sequence_number, False
+    def _get_events(submission: SubmissionData) -> List[Event]:
+        process_events = [("new_process", p) for p in submission["events"]["new_process"]]
+        connection_events = [
+            ("network_connection", p) for p in submission["events"]["network_connection"]
+        ]
+        return process_events + connection_events
+
+    async def _publish_submission(
+        self,
+        submission: SubmissionData,
+        delivered_events_number: int,
+        sequence_number: Optional[str],
+    ) -> Tuple[int, Optional[str], bool]:
+        logger.debug(f"downstream a submission {submission}")
+        partition_key = str(submission["device_id"])
+        events = self._get_events(submission)[delivered_events_number:]
+        records = self.encoder.encode_events(submission["device_id"], events)
+        if self.aggregation_max_bytes is None:
+            aggregated_records = [(record, 1) for record in records]
         else:
-            # create a new pending submission
+            aggregated_records = aggregate_records(records, self.aggregation_max_bytes)
+        for record, events_number in aggregated_records:
+            if self.compressor is not None:
+                record = self.compressor.compress(record)
+            # wait for the record before sending the next one to keep the order
+            started_at = time.perf_counter()
             try:
-                await cursor.execute(
-                    "INSERT INTO submissions (id, status, number_of_delivered_events, created_at) "
-                    "VALUES (%s, %s, %s, %s)",
-                    (submission_id, "pending", 0, datetime.now(UTC))
-                )
-            except psycopg.errors.UniqueViolation:
-                logger.debug(f"the other worker is processing the submission {submission_id}")
+                sequence_number = await self.batcher.put(record, partition_key)
+            except KinesisClientException:
+                add_stage(submission["submission_id"], "put_failed", time.perf_counter() - started_at)
                 return delivered_events_number, sequence_number, False
+            add_stage(submission["submission_id"], "put", time.perf_counter() - started_at)
+            delivered_events_number += events_number
+            logger.debug(f"receive a sequence number {sequence_number} for {record!r}")
 
-        return delivered_events_number, sequence_number, None
-
-    async def _send_event(
-        self,
-        connection,
-        delivered_events_number,
-        sequence_number,
-        submission_id,
-        json_event,
-        device_id
-    ) -> Optional[str]:
-        await connection.execute(
-            "UPDATE submissions SET number_of_delivered_events=%s, sequence_number=%s, "
-            "updated_at=%s WHERE id=%s",
-            (delivered_events_number, sequence_number, datetime.now(UTC), submission_id)
-        )
-        try:
-            sequence_number = await self.kinesis_client.put_record(
-                self.stream_name,
-                json_event.encode(),
-                str(device_id),
-                sequence_number
-            )
-        except KinesisClientException:
-            return None
-
-        return sequence_number
+        return delivered_events_number, sequence_number, True
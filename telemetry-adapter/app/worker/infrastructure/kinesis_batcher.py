@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Callable, Deque, List, Optional, Set
+
+from botocore.exceptions import ClientError
+
+from app.metrics import registry
+from app.worker.infrastructure.clients.exceptions import KinesisClientException
+from app.worker.infrastructure.clients.kinesis import KinesisClient
+from app.worker.infrastructure.rate_limiter import AIMDRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# PutRecords limits: https://docs.aws.amazon.com/kinesis/latest/APIReference/API_PutRecords.html
+MAX_RECORDS_PER_REQUEST = 500
+MAX_BYTES_PER_REQUEST = 5 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1024 * 1024
+THROTTLING_ERROR_CODES = {"ProvisionedThroughputExceededException", "ThrottlingException"}
+
+rate_limits = registry.gauge(
+    "kinesis_rate_limit_records_per_second", "Current client-side rate limits of PutRecords"
+)
+throttled_records = registry.counter(
+    "kinesis_throttled_records_total", "Records rejected by Kinesis because of throttling"
+)
+request_duration = registry.histogram("kinesis_request_duration_seconds", "PutRecords requests")
+request_errors = registry.counter("kinesis_request_errors_total", "Failed PutRecords requests")
+request_records = registry.histogram(
+    "kinesis_request_records", "Records in a PutRecords request", (1, 5, 10, 25, 50, 100, 250, 500)
+)
+put_duration = registry.histogram(
+    "kinesis_put_duration_seconds", "Time from queueing a record to its sequence number"
+)
+failed_records = registry.counter(
+    "kinesis_failed_records_total", "Records given up after all attempts"
+)
+
+
+@dataclass(eq=False)
+class _PendingRecord:
+    data: bytes
+    partition_key: str
+    future: asyncio.Future
+    size: int
+    attempt: int = 0
+    throttled_at: Optional[float] = None
+    retry_handle: Optional[asyncio.TimerHandle] = None
+
+
+class RecordWriter(ABC):
+    @abstractmethod
+    async def put(self, data: bytes, partition_key: str) -> str:
+        pass
+
+
+class KinesisRecordBatcher(RecordWriter):
+    """
+    Coalesces records from concurrent submissions into PutRecords requests.
+
+    A caller awaits `put` until its record is written and receives the
+    sequence number. Only failed entries of a request are retried. Callers
+    keep the event order by awaiting one record before putting the next one.
+
+    With `max_pending_records` a caller waits while that many records are
+    queued or in flight. When `shard_id` is set, `on_shard_mismatch` is
+    called if Kinesis writes a record to another shard.
+
+    With a rate limiter the batcher does not send more records per second
+    than the limiter allows. Throttled records are retried after a short
+    jittered delay without using their attempts until they have been
+    throttled for `throttle_retry_deadline` seconds.
+    """
+    def __init__(
+        self,
+        kinesis_client: KinesisClient,
+        stream_name: str,
+        max_records: int = MAX_RECORDS_PER_REQUEST,
+        max_bytes: int = MAX_BYTES_PER_REQUEST,
+        linger: float = 0.0,
+        max_attempts: int = 3,
+        retry_timeout: float = 0.1,
+        max_concurrent_requests: int = 4,
+        max_pending_records: Optional[int] = None,
+        shard_id: Optional[str] = None,
+        on_shard_mismatch: Optional[Callable[[], None]] = None,
+        rate_limiter: Optional[AIMDRateLimiter] = None,
+        throttle_retry_deadline: float = 10.0,
+    ):
+        self.kinesis_client = kinesis_client
+        self.stream_name = stream_name
+        self.max_records = min(max_records, MAX_RECORDS_PER_REQUEST)
+        self.max_bytes = min(max_bytes, MAX_BYTES_PER_REQUEST)
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self.retry_timeout = retry_timeout
+        self.shard_id = shard_id
+        self.on_shard_mismatch = on_shard_mismatch
+        self.rate_limiter = rate_limiter
+        self.throttle_retry_deadline = throttle_retry_deadline
+        self._rate_limit_labels = {"shard": shard_id or "all"}
+        if rate_limiter is not None:
+            rate_limits.set(rate_limiter.rate, **self._rate_limit_labels)
+        self._capacity = asyncio.Semaphore(max_pending_records) if max_pending_records else None
+        self._records_number = 0
+        self._pending: Deque[_PendingRecord] = deque()
+        self._has_pending = asyncio.Event()
+        self._requests = asyncio.Semaphore(max_concurrent_requests)
+        self._requests_in_flight: Set[asyncio.Task] = set()
+        self._retrying: Set[_PendingRecord] = set()
+        self._sender: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self._sender = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def put(self, data: bytes, partition_key: str) -> str:
+        size = len(data) + len(partition_key.encode())
+        if size > MAX_BYTES_PER_RECORD:
+            raise KinesisClientException(
+                f"The record size {size} exceeds {MAX_BYTES_PER_RECORD} bytes"
+            )
+        if self._capacity is not None:
+            await self._capacity.acquire()
+        self._records_number += 1
+        started_at = time.perf_counter()
+        try:
+            future = asyncio.get_running_loop().create_future()
+            self._enqueue(_PendingRecord(data, partition_key, future, size))
+            sequence_number = await future
+            put_duration.observe(time.perf_counter() - started_at)
+            return sequence_number
+        finally:
+            self._records_number -= 1
+            if self._capacity is not None:
+                self._capacity.release()
+
+    @property
+    def records_number(self) -> int:
+        return self._records_number
+
+    async def close(self):
+        if self._sender is not None:
+            self._sender.cancel()
+            await asyncio.gather(self._sender, return_exceptions=True)
+            self._sender = None
+        await asyncio.gather(*self._requests_in_flight, return_exceptions=True)
+        for record in self._retrying:
+            record.retry_handle.cancel()
+            self._pending.append(record)
+        self._retrying.clear()
+        while self._pending:
+            record = self._pending.popleft()
+            if not record.future.done():
+                record.future.set_exception(KinesisClientException("The batcher is closed"))
+
+    def _enqueue(self, record: _PendingRecord, first: bool = False):
+        if first:
+            self._pending.appendleft(record)
+        else:
+            self._pending.append(record)
+        self._has_pending.set()
+
+    def _take_batch(self) -> List[_PendingRecord]:
+        batch, batch_size = [], 0
+        max_records = self.max_records
+        if self.rate_limiter is not None:
+            max_records = min(max_records, self.rate_limiter.available())
+        while self._pending and len(batch) < max_records:
+            record = self._pending[0]
+            if record.future.done():
+                # the caller has been cancelled
+                self._pending.popleft()
+                continue
+            if batch and batch_size + record.size > self.max_bytes:
+                break
+            batch.append(self._pending.popleft())
+            batch_size += record.size
+        if not self._pending:
+            self._has_pending.clear()
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            # let concurrent submissions enqueue their records
+            await asyncio.sleep(self.linger)
+            await self._requests.acquire()
+            batch = self._take_batch()
+            if not batch:
+                self._requests.release()
+                continue
+            if self.rate_limiter is not None:
+                try:
+                    await self.rate_limiter.acquire(len(batch))
+                except asyncio.CancelledError:
+                    # return the batch, so close() fails its records
+                    for record in reversed(batch):
+                        self._enqueue(record, first=True)
+                    self._requests.release()
+                    raise
+            task = asyncio.create_task(self._send(batch))
+            self._requests_in_flight.add(task)
+            task.add_done_callback(self._requests_in_flight.discard)
+
+    async def _send(self, batch: List[_PendingRecord]):
+        request_records.observe(len(batch))
+        started_at = time.perf_counter()
+        try:
+            try:
+                results = await self.kinesis_client.put_records(
+                    self.stream_name,
+                    [(record.data, record.partition_key) for record in batch]
+                )
+                request_duration.observe(time.perf_counter() - started_at)
+            except KinesisClientException as ex:
+                request_errors.inc()
+                cause = ex.__cause__
+                if isinstance(cause, ClientError) and (
+                    cause.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+                ):
+                    self._on_throttle(batch, str(cause))
+                else:
+                    self._retry(batch, str(cause or ex))
+                return
+
+            failed, throttled, error, shard_mismatch = [], [], None, False
+            for record, result in zip(batch, results):
+                if result.get("ErrorCode") in THROTTLING_ERROR_CODES:
+                    throttled.append(record)
+                    error = f"{result['ErrorCode']}: {result.get('ErrorMessage')}"
+                    continue
+                if result.get("ErrorCode") is not None:
+                    failed.append(record)
+                    error = f"{result['ErrorCode']}: {result.get('ErrorMessage')}"
+                    continue
+                record.throttled_at = None
+                if self.shard_id is not None and result.get("ShardId") != self.shard_id:
+                    shard_mismatch = True
+                if not record.future.done():
+                    record.future.set_result(result["SequenceNumber"])
+            if shard_mismatch and self.on_shard_mismatch is not None:
+                self.on_shard_mismatch()
+            if failed or throttled:
+                logger.debug(
+                    f"{len(failed) + len(throttled)} of {len(batch)} records were not put: {error}"
+                )
+            if throttled:
+                self._on_throttle(throttled, error)
+            elif self.rate_limiter is not None:
+                self.rate_limiter.on_success()
+                rate_limits.set(self.rate_limiter.rate, **self._rate_limit_labels)
+            if failed:
+                self._retry(failed, error)
+        except Exception as ex:
+            # fail the batch instead of leaving its callers waiting for ever
+            request_errors.inc()
+            logger.warning(f"an unexpected error while putting {len(batch)} records: {ex}")
+            for record in batch:
+                if not record.future.done():
+                    record.future.set_exception(KinesisClientException(f"Unexpected error: {ex}"))
+        finally:
+            self._requests.release()
+
+    def _on_throttle(self, records: List[_PendingRecord], error: Optional[str]):
+        throttled_records.inc(len(records), **self._rate_limit_labels)
+        if self.rate_limiter is not None:
+            self.rate_limiter.on_throttle()
+            rate_limits.set(self.rate_limiter.rate, **self._rate_limit_labels)
+        now = time.monotonic()
+        loop = asyncio.get_running_loop()
+        exhausted = []
+        for record in records:
+            if record.future.done():
+                continue
+            if record.throttled_at is None:
+                record.throttled_at = now
+            if now - record.throttled_at >= self.throttle_retry_deadline:
+                record.throttled_at = None
+                exhausted.append(record)
+                continue
+            # the rate limiter slows down the next requests, so throttled
+            # records are retried soon and keep their attempts
+            delay = random.uniform(0, self.retry_timeout)
+            record.retry_handle = loop.call_later(delay, self._enqueue_retry, record)
+            self._retrying.add(record)
+        if exhausted:
+            self._retry(exhausted, error)
+
+    def _retry(self, records: List[_PendingRecord], error: Optional[str]):
+        loop = asyncio.get_running_loop()
+        for record in records:
+            if record.future.done():
+                continue
+            record.attempt += 1
+            if record.attempt >= self.max_attempts:
+                logger.warning(
+                    f"Can not put a record to the stream {self.stream_name}: "
+                    f"the partition key: {record.partition_key}: "
+                    f"attempts: {record.attempt}: error: {error}"
+                )
+                failed_records.inc()
+                record.future.set_exception(KinesisClientException(error))
+                continue
+            delay = random.uniform(0, self.retry_timeout * 2 ** (record.attempt - 1))
+            record.retry_handle = loop.call_later(delay, self._enqueue_retry, record)
+            self._retrying.add(record)
+
+    def _enqueue_retry(self, record: _PendingRecord):
+        self._retrying.discard(record)
+        record.retry_handle = None
+        self._enqueue(record, first=True)
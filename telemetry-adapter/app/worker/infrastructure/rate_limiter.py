@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+
+class AIMDRateLimiter:
+    """
+    A token bucket of records per second with an additive increase and
+    a multiplicative decrease of its rate (AIMD).
+
+    The rate grows by `increase` after every request without throttling
+    and is multiplied by `decrease_factor` after a throttled one, so it
+    follows the throughput the shard currently accepts. The bucket holds
+    one second of tokens, and a large request may borrow tokens from
+    the next ones.
+    """
+    def __init__(
+        self,
+        max_rate: float,
+        min_rate: float = 10.0,
+        increase: float = 50.0,
+        decrease_factor: float = 0.5,
+    ):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.rate = max_rate
+        self._tokens = max_rate
+        self._updated_at = time.monotonic()
+
+    async def acquire(self, tokens: int):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        self._tokens -= tokens
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def available(self) -> int:
+        return max(1, int(self.rate))
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
@@ -0,0 +1,238 @@
+import ipaddress
+import json
+import struct
+from abc import ABC, abstractmethod
+from datetime import datetime, UTC
+from typing import Any, Dict, List, Mapping, Sequence, Tuple, Union
+from uuid import UUID, uuid4
+
+from app.worker.infrastructure.types import NetworkConnectionData, NewProcessData
+
+Event = Tuple[str, Union[NewProcessData, NetworkConnectionData]]
+
+# A JSON record starts with "{". Other records start with the header:
+# the magic byte, the record kind and the kind version.
+RECORD_MAGIC = 0xFE
+COMPACT_EVENT = 0x01
+COMPACT_EVENT_VERSION = 1
+AGGREGATED_RECORD = 0x02
+AGGREGATED_RECORD_VERSION = 1
+
+EVENT_TYPE_CODES = {"new_process": 1, "network_connection": 2}
+EVENT_TYPES = {code: event_type for event_type, code in EVENT_TYPE_CODES.items()}
+
+_COMPACT_EVENT_HEADER = bytes([RECORD_MAGIC, COMPACT_EVENT, COMPACT_EVENT_VERSION])
+_AGGREGATED_RECORD_HEADER = bytes([RECORD_MAGIC, AGGREGATED_RECORD, AGGREGATED_RECORD_VERSION])
+_TIMESTAMP = struct.Struct(">q")
+
+
+class EventEncoder(ABC):
+    @abstractmethod
+    def encode_events(self, device_id: UUID, events: Sequence[Event]) -> List[bytes]:
+        pass
+
+
+class JsonEventEncoder(EventEncoder):
+    """
+    Writes events in the documented JSON format.
+
+    The envelope is the same for all events of a submission, so it is
+    encoded once, and only an ID and details are encoded per event.
+    """
+    def encode_events(self, device_id: UUID, events: Sequence[Event]) -> List[bytes]:
+        processing_timestamp = datetime.now(UTC).isoformat().replace("+00:00", "Z")
+        envelope = (
+            f'","device_id":"{device_id}",'
+            f'"processing_timestamp":"{processing_timestamp}","event_details":'
+        ).encode()
+        event_types = {
+            event_type: f'","event_type":"{event_type}'.encode() for event_type in EVENT_TYPE_CODES
+        }
+        dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+        return [
+            b"".join((
+                b'{"id":"',
+                str(uuid4()).encode(),
+                event_types[event_type],
+                envelope,
+                dumps(event_details).encode(),
+                b"}",
+            ))
+            for event_type, event_details in events
+        ]
+
+
+def _encode_varint(value: int) -> bytes:
+    result = bytearray()
+    while value > 0x7F:
+        result.append(value & 0x7F | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _decode_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    result, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def _encode_string(value: str) -> bytes:
+    encoded = value.encode()
+    return _encode_varint(len(encoded)) + encoded
+
+
+def _decode_string(data: bytes, offset: int) -> Tuple[str, int]:
+    length, offset = _decode_varint(data, offset)
+    return data[offset:offset + length].decode(), offset + length
+
+
+def _encode_ip_address(value: str) -> bytes:
+    packed = ipaddress.ip_address(value).packed
+    return bytes([len(packed)]) + packed
+
+
+def _decode_ip_address(data: bytes, offset: int) -> Tuple[str, int]:
+    length = data[offset]
+    packed = data[offset + 1:offset + 1 + length]
+    return str(ipaddress.ip_address(packed)), offset + 1 + length
+
+
+class CompactEventEncoder(EventEncoder):
+    """
+    Writes events in the compact binary format, version 1 (big-endian):
+
+    header         3 bytes: 0xFE, 0x01 (a compact event), 0x01 (the version)
+    id             16 bytes
+    device_id      16 bytes
+    timestamp      int64, microseconds since the Unix epoch in UTC
+    event_type     uint8: 1 - new_process, 2 - network_connection
+    new_process:         cmdl, user - varint length + UTF-8
+    network_connection:  source_ip, destination_ip - uint8 length (4 or 16) + bytes,
+                         destination_port - varint
+    """
+    def encode_events(self, device_id: UUID, events: Sequence[Event]) -> List[bytes]:
+        now = datetime.now(UTC)
+        envelope = device_id.bytes + _TIMESTAMP.pack(
+            int(now.timestamp()) * 1_000_000 + now.microsecond
+        )
+        records = []
+        for event_type, event_details in events:
+            if event_type == "new_process":
+                details = (
+                    _encode_string(event_details["cmdl"]) + _encode_string(event_details["user"])
+                )
+            else:
+                details = (
+                    _encode_ip_address(event_details["source_ip"])
+                    + _encode_ip_address(event_details["destination_ip"])
+                    + _encode_varint(event_details["destination_port"])
+                )
+            records.append(b"".join((
+                _COMPACT_EVENT_HEADER,
+                uuid4().bytes,
+                envelope,
+                bytes([EVENT_TYPE_CODES[event_type]]),
+                details,
+            )))
+        return records
+
+
+def decode_compact_event(data: bytes) -> Dict[str, Any]:
+    if data[:2] != _COMPACT_EVENT_HEADER[:2]:
+        raise ValueError("The record is not a compact event")
+    if data[2] != COMPACT_EVENT_VERSION:
+        raise ValueError(f"Unsupported compact event version: {data[2]}")
+    offset = len(_COMPACT_EVENT_HEADER)
+    event_id = UUID(bytes=data[offset:offset + 16])
+    device_id = UUID(bytes=data[offset + 16:offset + 32])
+    (timestamp,) = _TIMESTAMP.unpack_from(data, offset + 32)
+    event_type = EVENT_TYPES[data[offset + 40]]
+    offset += 41
+    details: Mapping[str, Any]
+    if event_type == "new_process":
+        cmdl, offset = _decode_string(data, offset)
+        user, offset = _decode_string(data, offset)
+        details = {"cmdl": cmdl, "user": user}
+    else:
+        source_ip, offset = _decode_ip_address(data, offset)
+        destination_ip, offset = _decode_ip_address(data, offset)
+        destination_port, offset = _decode_varint(data, offset)
+        details = {
+            "source_ip": source_ip,
+            "destination_ip": destination_ip,
+            "destination_port": destination_port,
+        }
+    processing_timestamp = datetime.fromtimestamp(timestamp // 1_000_000, UTC).replace(
+        microsecond=timestamp % 1_000_000
+    )
+    return {
+        "id": str(event_id),
+        "event_type": event_type,
+        "device_id": str(device_id),
+        "processing_timestamp": processing_timestamp.isoformat().replace("+00:00", "Z"),
+        "event_details": details,
+    }
+
+
+def aggregate_records(records: Sequence[bytes], max_bytes: int) -> List[Tuple[bytes, int]]:
+    """
+    Packs consecutive records into aggregated records, version 1:
+
+    header         3 bytes: 0xFE, 0x02 (an aggregated record), 0x01 (the version)
+    count          varint, the number of records
+    records        varint length + the record, in the original order
+
+    An aggregated record holds at least one record and is not larger than
+    `max_bytes` unless its only record is. Returns the aggregated records
+    with the number of records in each.
+    """
+    aggregated: List[Tuple[bytes, int]] = []
+    frames: List[bytes] = []
+    size = 0
+    for record in records:
+        frame = _encode_varint(len(record)) + record
+        # the header and the count varint take at most 3 + 3 bytes for 2 MiB of records
+        if frames and size + len(frame) + 6 > max_bytes:
+            aggregated.append((_pack_aggregated_record(frames), len(frames)))
+            frames, size = [], 0
+        frames.append(frame)
+        size += len(frame)
+    if frames:
+        aggregated.append((_pack_aggregated_record(frames), len(frames)))
+    return aggregated
+
+
+def _pack_aggregated_record(frames: List[bytes]) -> bytes:
+    return b"".join((_AGGREGATED_RECORD_HEADER, _encode_varint(len(frames)), *frames))
+
+
+def deaggregate(data: bytes) -> List[bytes]:
+    """
+    Splits a Kinesis record into event records. A record that is not
+    aggregated is returned as it is.
+    """
+    if data[:2] != _AGGREGATED_RECORD_HEADER[:2]:
+        return [data]
+    if data[2] != AGGREGATED_RECORD_VERSION:
+        raise ValueError(f"Unsupported aggregated record version: {data[2]}")
+    count, offset = _decode_varint(data, len(_AGGREGATED_RECORD_HEADER))
+    records = []
+    for _ in range(count):
+        length, offset = _decode_varint(data, offset)
+        records.append(data[offset:offset + length])
+        offset += length
+    if offset != len(data):
+        raise ValueError("The aggregated record is corrupted")
+    return records
+
+
+def get_event_encoder(encoding: str) -> EventEncoder:
+    if encoding == "compact":
+        return CompactEventEncoder()
+    return JsonEventEncoder()
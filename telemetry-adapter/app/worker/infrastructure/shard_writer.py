@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import logging
+import traceback
+from bisect import bisect_right
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set
+
+from app.metrics import registry
+from app.worker.infrastructure.clients.exceptions import KinesisClientException
+from app.worker.infrastructure.clients.kinesis import KinesisClient
+from app.worker.infrastructure.kinesis_batcher import KinesisRecordBatcher, RecordWriter
+from app.worker.infrastructure.rate_limiter import AIMDRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# the shortest time between refreshes requested by unexpected shards
+MIN_REFRESH_INTERVAL = 1.0
+
+shard_map_refreshes = registry.counter(
+    "kinesis_shard_map_refreshes_total", "Refreshes of the Kinesis shard map"
+)
+shard_records = registry.gauge(
+    "kinesis_shard_pending_records", "Records queued or in flight by shards"
+)
+
+
+class ShardMap:
+    """
+    Finds the shard of a partition key the way Kinesis does: by the MD5 hash
+    of the key in the hash key ranges of the open shards.
+    """
+    def __init__(self, shards: List[Mapping[str, Any]]):
+        # closed shards of a resharded stream have an ending sequence number
+        open_shards = sorted(
+            (
+                (int(shard["HashKeyRange"]["StartingHashKey"]), shard["ShardId"])
+                for shard in shards
+                if "EndingSequenceNumber" not in shard.get("SequenceNumberRange", {})
+            ),
+        )
+        if not open_shards:
+            raise ValueError("The stream has no open shards")
+        self._starting_hash_keys = [hash_key for hash_key, _ in open_shards]
+        self.shard_ids = [shard_id for _, shard_id in open_shards]
+
+    def get_shard_id(self, partition_key: str) -> str:
+        hash_key = int.from_bytes(hashlib.md5(partition_key.encode()).digest(), "big")
+        return self.shard_ids[bisect_right(self._starting_hash_keys, hash_key) - 1]
+
+
+class ShardedKinesisWriter(RecordWriter):
+    """
+    Routes records to a batcher of their shard, so a throttled or busy
+    shard only holds up the devices written to it.
+
+    The shard map is refreshed periodically and as soon as Kinesis writes
+    a record to an unexpected shard after resharding. Batchers of closed
+    shards are closed when their records are written. Every shard has its
+    own rate limiter made by `rate_limiter_factory`.
+    """
+    def __init__(
+        self,
+        kinesis_client: KinesisClient,
+        stream_name: str,
+        refresh_interval: float = 60.0,
+        rate_limiter_factory: Optional[Callable[[], AIMDRateLimiter]] = None,
+        **batcher_options,
+    ):
+        self.kinesis_client = kinesis_client
+        self.stream_name = stream_name
+        self.refresh_interval = refresh_interval
+        self.rate_limiter_factory = rate_limiter_factory
+        self.batcher_options = batcher_options
+        self._shard_map: Optional[ShardMap] = None
+        self._batchers: Dict[str, KinesisRecordBatcher] = {}
+        self._retiring: Set[asyncio.Task] = set()
+        self._refresh_requested = asyncio.Event()
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        await self.refresh()
+        self._refresher = asyncio.create_task(self._refresh_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def put(self, data: bytes, partition_key: str) -> str:
+        shard_id = self._shard_map.get_shard_id(partition_key)
+        batcher = self._batchers[shard_id]
+        shard_records.inc(shard=shard_id)
+        try:
+            return await batcher.put(data, partition_key)
+        finally:
+            shard_records.dec(shard=shard_id)
+
+    async def refresh(self):
+        shard_map = ShardMap(await self.kinesis_client.list_shards(self.stream_name))
+        for shard_id in shard_map.shard_ids:
+            if shard_id not in self._batchers:
+                batcher = KinesisRecordBatcher(
+                    self.kinesis_client,
+                    self.stream_name,
+                    shard_id=shard_id,
+                    on_shard_mismatch=self._refresh_requested.set,
+                    rate_limiter=self.rate_limiter_factory() if self.rate_limiter_factory else None,
+                    **self.batcher_options,
+                )
+                self._batchers[shard_id] = await batcher.__aenter__()
+        for shard_id in set(self._batchers) - set(shard_map.shard_ids):
+            batcher = self._batchers.pop(shard_id)
+            # the records of a closed shard are written to its child shards
+            batcher.on_shard_mismatch = None
+            task = asyncio.create_task(self._retire(batcher))
+            self._retiring.add(task)
+            task.add_done_callback(self._retiring.discard)
+        self._shard_map = shard_map
+        shard_map_refreshes.inc()
+        logger.info(f"The stream {self.stream_name} has {len(shard_map.shard_ids)} open shards")
+
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+        for task in list(self._retiring):
+            task.cancel()
+        await asyncio.gather(*self._retiring, return_exceptions=True)
+        await asyncio.gather(*(batcher.close() for batcher in self._batchers.values()))
+        self._batchers.clear()
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._refresh_requested.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.refresh()
+            except (KinesisClientException, ValueError) as ex:
+                logger.warning(f"Can not refresh the shard map of the stream {self.stream_name}: {ex}")
+            except Exception as ex:
+                # keep refreshing, the records are routed by the previous map until then
+                exc_trace = "".join(traceback.format_tb(ex.__traceback__))
+                logger.warning(
+                    f"Can not refresh the shard map of the stream {self.stream_name}: {exc_trace}: {ex}"
+                )
+            await asyncio.sleep(MIN_REFRESH_INTERVAL)
+            self._refresh_requested.clear()
+
+    @staticmethod
+    async def _retire(batcher: KinesisRecordBatcher):
+        try:
+            # callers of the closed shard still await their records
+            while batcher.records_number:
+                await asyncio.sleep(1)
+        finally:
+            await batcher.close()
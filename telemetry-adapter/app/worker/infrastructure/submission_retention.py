@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import re
+import time
+from datetime import UTC, date, datetime, time as datetime_time, timedelta
+from typing import Dict, Optional
+
+import psycopg
+from psycopg import sql
+from psycopg_pool import AsyncConnectionPool
+
+from app.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+table_size = registry.gauge("db_submissions_table_bytes", "The size of submission partitions with indexes")
+partitions_number = registry.gauge("db_submissions_partitions", "Partitions of the submissions table")
+retention_duration = registry.histogram("db_retention_duration_seconds", "Runs of the retention job")
+dropped_partitions = registry.counter("db_retention_dropped_partitions_total", "Dropped daily partitions")
+pruned_rows = registry.counter("db_retention_pruned_rows_total", "Rows deleted from the default partition")
+retention_errors = registry.counter("db_retention_errors_total", "Failed runs of the retention job")
+
+# one worker process maintains the partitions at a time
+RETENTION_LOCK_ID = 0x7375626d
+DAILY_PARTITION = re.compile(r"^submissions_p(\d{8})$")
+PRUNE_BATCH_SIZE = 10_000
+
+LIST_PARTITIONS = """
+SELECT child.relname, pg_total_relation_size(child.oid)
+FROM pg_inherits JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+WHERE pg_inherits.inhparent = 'submissions'::regclass
+"""
+
+PRUNE_DEFAULT_PARTITION = """
+DELETE FROM submissions_default WHERE ctid = ANY(ARRAY(
+    SELECT ctid FROM submissions_default WHERE created_at < %(cutoff)s LIMIT %(limit)s
+))
+"""
+
+
+class SubmissionPartitionManager:
+    """
+    Maintains the daily partitions of the submissions table: creates
+    the partitions of the next `partitions_ahead` days and drops the ones
+    older than `retention`, the window in which redelivered submissions
+    are deduplicated. The rows older than `retention` in the default
+    partition are deleted in batches.
+    """
+    def __init__(
+        self,
+        pg_connection_pool: AsyncConnectionPool,
+        retention: timedelta,
+        partitions_ahead: int,
+        interval: float,
+        lock_timeout: float = 5.0,
+    ):
+        self.connection_pool = pg_connection_pool
+        self.retention = retention
+        self.partitions_ahead = partitions_ahead
+        self.interval = interval
+        self.lock_timeout = lock_timeout
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def maintain(self):
+        started_at = time.perf_counter()
+        async with self.connection_pool.connection() as conn:
+            await conn.set_autocommit(True)
+            cursor = await conn.execute("SELECT pg_try_advisory_lock(%s)", (RETENTION_LOCK_ID,))
+            if not (await cursor.fetchone())[0]:
+                logger.debug("the other worker maintains the submission partitions")
+                return
+            try:
+                # DDL waits for queries of the table, and the queries wait for DDL
+                await conn.execute(f"SET lock_timeout = '{int(self.lock_timeout * 1000)}ms'")
+                partitions = await self._get_partitions(conn)
+                cutoff = datetime.now(UTC) - self.retention
+                await self._create_partitions(conn, partitions)
+                await self._drop_partitions(conn, partitions, cutoff)
+                await self._prune_default_partition(conn, cutoff)
+                sizes = await self._get_partitions(conn)
+                table_size.set(sum(sizes.values()))
+                partitions_number.set(len(sizes))
+            finally:
+                await conn.execute("RESET lock_timeout")
+                await conn.execute("SELECT pg_advisory_unlock(%s)", (RETENTION_LOCK_ID,))
+        retention_duration.observe(time.perf_counter() - started_at)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.maintain()
+            except psycopg.Error as ex:
+                retention_errors.inc()
+                logger.warning(f"DB error while maintaining submission partitions: {ex}")
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    async def _get_partitions(conn: psycopg.AsyncConnection) -> Dict[str, int]:
+        cursor = await conn.execute(LIST_PARTITIONS)
+        return {name: size for name, size in await cursor.fetchall()}
+
+    async def _create_partitions(self, conn: psycopg.AsyncConnection, partitions: Dict[str, int]):
+        today = datetime.now(UTC).date()
+        for days in range(self.partitions_ahead + 1):
+            day = today + timedelta(days=days)
+            name = f"submissions_p{day:%Y%m%d}"
+            if name in partitions:
+                continue
+            try:
+                await conn.execute(sql.SQL(
+                    "CREATE TABLE {} PARTITION OF submissions FOR VALUES FROM ({}) TO ({})"
+                ).format(
+                    sql.Identifier(name),
+                    sql.Literal(_get_day_start(day)),
+                    sql.Literal(_get_day_start(day + timedelta(days=1))),
+                ))
+            except psycopg.errors.CheckViolation:
+                # the rows of the day are in the default partition already,
+                # they are pruned from there
+                logger.warning(f"can not create the partition {name}: the default partition has its rows")
+                continue
+            logger.info(f"created the partition {name}")
+
+    async def _drop_partitions(
+        self, conn: psycopg.AsyncConnection, partitions: Dict[str, int], cutoff: datetime
+    ):
+        for name in sorted(partitions):
+            match = DAILY_PARTITION.match(name)
+            if match is None:
+                continue
+            day = datetime.strptime(match.group(1), "%Y%m%d").date()
+            if _get_day_start(day + timedelta(days=1)) > cutoff:
+                continue
+            await conn.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+            dropped_partitions.inc()
+            logger.info(f"dropped the partition {name}")
+
+    @staticmethod
+    async def _prune_default_partition(conn: psycopg.AsyncConnection, cutoff: datetime):
+        while True:
+            cursor = await conn.execute(
+                PRUNE_DEFAULT_PARTITION, {"cutoff": cutoff, "limit": PRUNE_BATCH_SIZE}
+            )
+            pruned_rows.inc(cursor.rowcount)
+            if cursor.rowcount < PRUNE_BATCH_SIZE:
+                break
+
+
+def _get_day_start(day: date) -> datetime:
+    return datetime.combine(day, datetime_time.min, UTC)
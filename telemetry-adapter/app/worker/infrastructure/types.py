@@ -1,7 +1,10 @@
+import ipaddress
+import socket
 from datetime import datetime
-from typing import List
+from typing import Annotated, Any, List
 
-from pydantic import BaseModel, IPvAnyAddress, PositiveInt, UUID4
+from pydantic import BaseModel, IPvAnyAddress, PlainValidator, PositiveInt, UUID4
+from typing_extensions import TypedDict
 
 
 class EventStreamerException(Exception):
@@ -29,3 +32,41 @@ class Submission(BaseModel):
     device_id: UUID4
     time_created: datetime
     events: Events
+
+
+def _validate_ip_address(value: Any) -> str:
+    if isinstance(value, str):
+        try:
+            socket.inet_pton(socket.AF_INET, value)
+            return value
+        except OSError:
+            pass
+    return str(ipaddress.ip_address(value))
+
+
+# The same schema as Submission, but validated submissions are plain dicts,
+# and IP addresses are kept as strings
+IPAddress = Annotated[str, PlainValidator(_validate_ip_address)]
+
+
+class NewProcessData(TypedDict):
+    cmdl: str
+    user: str
+
+
+class NetworkConnectionData(TypedDict):
+    source_ip: IPAddress
+    destination_ip: IPAddress
+    destination_port: PositiveInt
+
+
+class EventsData(TypedDict):
+    new_process: List[NewProcessData]
+    network_connection: List[NetworkConnectionData]
+
+
+class SubmissionData(TypedDict):
+    submission_id: UUID4
+    device_id: UUID4
+    time_created: datetime
+    events: EventsData
@@ -0,0 +1,30 @@
+import logging
+from typing import Annotated, List, Optional, Sequence
+
+from pydantic import Json, TypeAdapter, ValidationError, ValidatorFunctionWrapHandler, WrapValidator
+
+from app.worker.infrastructure.types import SubmissionData
+
+logger = logging.getLogger(__name__)
+
+
+def _skip_invalid_submission(
+    value: bytes,
+    handler: ValidatorFunctionWrapHandler
+) -> Optional[SubmissionData]:
+    try:
+        return handler(value)
+    except ValidationError as ex:
+        logger.warning(f"can not retrieve a submission from the message: {ex}. Submission: {value}")
+        return None
+
+
+# parses JSON and validates all submissions of a batch in one pass;
+# an invalid submission becomes None and does not fail the batch
+_submission_batch = TypeAdapter(
+    List[Annotated[Optional[Json[SubmissionData]], WrapValidator(_skip_invalid_submission)]]
+)
+
+
+def validate_submissions(bodies: Sequence[bytes]) -> List[Optional[SubmissionData]]:
+    return _submission_batch.validate_python(bodies)
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.metrics import registry
+from app.worker.infrastructure.clients.exceptions import QueueClientException
+from app.worker.infrastructure.clients.interfaces import QueueClient
+
+logger = logging.getLogger(__name__)
+
+tracked_messages = registry.gauge(
+    "visibility_tracked_messages", "Received messages whose visibility is extended"
+)
+visibility_extensions = registry.counter(
+    "visibility_extensions_total", "Visibility timeout extensions of messages in processing"
+)
+released_messages = registry.counter(
+    "visibility_released_messages_total", "Messages made visible again after a failure"
+)
+
+
+class VisibilityTracker:
+    """
+    Extends the visibility timeout of messages in processing with
+    ChangeMessageVisibilityBatch, so slow submissions are not redelivered
+    while a worker still processes them.
+
+    A released message is made visible at once, so another worker can take
+    it without waiting for the timeout. A message is not extended longer than
+    `max_extension` seconds after it was received.
+    """
+    def __init__(
+        self,
+        queue_client: QueueClient,
+        visibility_timeout: int,
+        interval: float,
+        max_extension: float,
+    ):
+        self.queue_client = queue_client
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval
+        self.max_extension = max_extension
+        # {deletion ID: (received at, visible at)}
+        self._messages: Dict[str, Tuple[float, float]] = {}
+        self._released: List[str] = []
+        self._has_released = asyncio.Event()
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self._heartbeat = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def track(self, deletion_ids: Iterable[str]):
+        now = asyncio.get_running_loop().time()
+        for deletion_id in deletion_ids:
+            self._messages[deletion_id] = (now, now + self.visibility_timeout)
+        tracked_messages.set(len(self._messages))
+
+    def untrack(self, deletion_id: str):
+        self._messages.pop(deletion_id, None)
+        tracked_messages.set(len(self._messages))
+
+    def release(self, deletion_ids: Iterable[str]):
+        for deletion_id in deletion_ids:
+            self._messages.pop(deletion_id, None)
+            self._released.append(deletion_id)
+        tracked_messages.set(len(self._messages))
+        self._has_released.set()
+
+    async def close(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+            self._heartbeat = None
+        try:
+            await self._make_visible()
+        except QueueClientException:
+            logger.warning(f"can not release {len(self._released)} messages")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._has_released.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._make_visible()
+                await self._extend()
+            except QueueClientException:
+                # the messages are extended or released on the next heartbeat
+                # if their timeout has not expired yet
+                logger.debug("can not change the visibility of messages")
+
+    async def _make_visible(self):
+        self._has_released.clear()
+        released, self._released = self._released, []
+        if not released:
+            return
+        try:
+            failed = await self.queue_client.change_visibility(released, 0)
+        except QueueClientException:
+            self._released.extend(released)
+            raise
+        released_messages.inc(len(released) - len(failed))
+
+    async def _extend(self):
+        now = asyncio.get_running_loop().time()
+        expiring = []
+        for deletion_id, (received_at, visible_at) in list(self._messages.items()):
+            if now - received_at >= self.max_extension:
+                logger.warning(f"stop extending the visibility of the message {deletion_id}")
+                self._messages.pop(deletion_id)
+            # the message must not become visible before the next heartbeat
+            elif visible_at - now < 2 * self.interval:
+                expiring.append(deletion_id)
+        if expiring:
+            failed = await self.queue_client.change_visibility(expiring, self.visibility_timeout)
+            visible_at = now + self.visibility_timeout
+            for deletion_id in expiring:
+                if deletion_id in failed:
+                    # the message is deleted or its receipt handle has expired
+                    self._messages.pop(deletion_id, None)
+                elif deletion_id in self._messages:
+                    self._messages[deletion_id] = (self._messages[deletion_id][0], visible_at)
+            visibility_extensions.inc(len(expiring) - len(failed))
+        tracked_messages.set(len(self._messages))
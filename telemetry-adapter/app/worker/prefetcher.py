@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import traceback
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+
+from app.worker.services.exceptions import SubmissionReceivingError
+
+logger = logging.getLogger(__name__)
+
+# how often a parked poller checks whether it is needed again
+PARKED_POLLER_TIMEOUT = 0.5
+
+MessageBatch = List[Mapping[str, Any]]
+
+
+class MessagePrefetcher:
+    """
+    Keeps the next receive requests in flight while the worker processes
+    the current batch. Every poller keeps one receive request in flight.
+
+    The buffer is bounded, so the poller stops receiving when the worker
+    falls behind. Batches older than `max_message_age` are dropped because
+    their visibility timeout is about to expire and SQS will redeliver them.
+
+    `get_active_pollers` returns how many of the pollers receive messages,
+    the other ones are parked. `set_pollers` changes the number of pollers
+    at runtime; a removed poller exits after putting its last batch.
+    """
+    def __init__(
+        self,
+        receive: Callable[[], Awaitable[MessageBatch]],
+        buffer_size: int,
+        max_message_age: float,
+        error_timeout: float,
+        pollers: int = 1,
+        get_active_pollers: Optional[Callable[[], Optional[int]]] = None,
+    ):
+        self.receive = receive
+        self.max_message_age = max_message_age
+        self.error_timeout = error_timeout
+        self.pollers = pollers
+        self.get_active_pollers = get_active_pollers
+        self._batches: asyncio.Queue[Tuple[float, MessageBatch]] = asyncio.Queue(maxsize=buffer_size)
+        self._pollers: Dict[int, asyncio.Task] = {}
+        self._is_started = False
+        # received batches of the pollers that wait for room in the buffer
+        self._unbuffered: List[MessageBatch] = []
+
+    async def __aenter__(self):
+        self._is_started = True
+        self.set_pollers(self.pollers)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    async def stop(self) -> List[MessageBatch]:
+        """
+        Stops receiving and returns the batches that are not taken yet.
+        """
+        self._is_started = False
+        pollers = list(self._pollers.values())
+        self._pollers.clear()
+        for poller in pollers:
+            poller.cancel()
+        await asyncio.gather(*pollers, return_exceptions=True)
+        batches = self._unbuffered
+        self._unbuffered = []
+        while not self._batches.empty():
+            batches.append(self._batches.get_nowait()[1])
+        return batches
+
+    def set_pollers(self, pollers: int):
+        self.pollers = pollers
+        if not self._is_started:
+            return
+        for index in range(pollers):
+            poller = self._pollers.get(index)
+            if poller is None or poller.done():
+                self._pollers[index] = asyncio.create_task(self._poll(index))
+
+    async def get_messages(self) -> MessageBatch:
+        _, batch = await self.get_batch()
+        return batch
+
+    async def get_batch(self) -> Tuple[float, MessageBatch]:
+        """
+        Returns the next batch with the event loop time it was received at.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            received_at, batch = await self._batches.get()
+            age = loop.time() - received_at
+            if age < self.max_message_age:
+                return received_at, batch
+            logger.warning(
+                f"drop {len(batch)} prefetched messages: "
+                f"the age {age:.2f}s exceeds {self.max_message_age}s"
+            )
+
+    async def _poll(self, index: int):
+        loop = asyncio.get_running_loop()
+        while index < self.pollers:
+            if self.get_active_pollers is not None:
+                active_pollers = self.get_active_pollers()
+                if active_pollers is not None and index >= active_pollers:
+                    await asyncio.sleep(PARKED_POLLER_TIMEOUT)
+                    continue
+            try:
+                batch = await self.receive()
+            except SubmissionReceivingError:
+                logger.debug("can not receive submissions")
+                await asyncio.sleep(self.error_timeout)
+                continue
+            except Exception as ex:
+                # a poller must not die: nothing restarts it
+                exc_trace = "".join(traceback.format_tb(ex.__traceback__))
+                logger.warning(f"an unexpected receiving error: {exc_trace}: {ex}")
+                await asyncio.sleep(self.error_timeout)
+                continue
+            if batch:
+                self._unbuffered.append(batch)
+                await self._batches.put((loop.time(), batch))
+                self._unbuffered.remove(batch)
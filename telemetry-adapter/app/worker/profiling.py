@@ -0,0 +1,29 @@
+import asyncio
+import cProfile
+import marshal
+import pstats
+
+_lock = asyncio.Lock()
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+async def profile_event_loop(duration: float) -> bytes:
+    """
+    Profiles all code running in the event loop (the worker pipeline and
+    the HTTP server) for `duration` seconds. Returns the stats in the format
+    of `pstats.Stats.dump_stats`, readable by pstats and snakeviz.
+    """
+    if _lock.locked():
+        raise ProfilerBusyError("A profile is already running")
+    async with _lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            profiler.disable()
+    stats = pstats.Stats(profiler)
+    return marshal.dumps(stats.stats)
@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+from uuid import UUID
+
+from app.metrics import registry
+
+cache_hits = registry.counter(
+    "completed_submissions_cache_hits_total", "Duplicates acknowledged without a DB query"
+)
+cache_misses = registry.counter(
+    "completed_submissions_cache_misses_total", "Submissions missing in the cache"
+)
+cache_size = registry.gauge(
+    "completed_submissions_cache_size", "Submissions in the cache"
+)
+
+
+class CompletedSubmissionCache:
+    """
+    Remembers recently completed submissions to acknowledge redelivered
+    duplicates without a database query.
+
+    Entries expire after `ttl` seconds, and the oldest entries are evicted
+    when the cache has `max_size` entries.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # all entries have the same TTL, so the first entries expire first
+        self._expires_at: OrderedDict[UUID, float] = OrderedDict()
+
+    def __len__(self):
+        return len(self._expires_at)
+
+    def __contains__(self, submission_id: UUID) -> bool:
+        expires_at = self._expires_at.get(submission_id)
+        if expires_at is not None and expires_at > time.monotonic():
+            cache_hits.inc()
+            return True
+        cache_misses.inc()
+        return False
+
+    def add(self, submission_id: UUID):
+        if self.max_size == 0:
+            return
+        now = time.monotonic()
+        self._expires_at[submission_id] = now + self.ttl
+        self._expires_at.move_to_end(submission_id)
+        while self._expires_at:
+            oldest_id, expires_at = next(iter(self._expires_at.items()))
+            if len(self._expires_at) <= self.max_size and expires_at > now:
+                break
+            del self._expires_at[oldest_id]
+        cache_size.set(len(self._expires_at))
@@ -1,13 +1,17 @@
 import logging
-from typing import Tuple, List, Mapping, Any, Iterable
+from typing import Tuple, List, Mapping, Any, Iterable, Optional
 
 import pydantic
 from pydantic import BaseModel
 
+from app.worker.infrastructure.ack_coalescer import AckCoalescer
 from app.worker.infrastructure.clients.exceptions import QueueClientException, QueueClientUnexpectedMessage
 from app.worker.infrastructure.clients.interfaces import QueueClient
 from app.worker.infrastructure.event_streamer import EventStreamer
-from app.worker.infrastructure.types import EventStreamerException, Submission
+from app.worker.infrastructure.types import EventStreamerException, SubmissionData
+from app.worker.infrastructure.validation import validate_submissions
+from app.worker.infrastructure.visibility_tracker import VisibilityTracker
+from app.worker.services.cache import CompletedSubmissionCache
 from app.worker.services.exceptions import SubmissionReceivingError
 
 
@@ -16,29 +20,42 @@ logger = logging.getLogger(__name__)
 
 class Message(BaseModel):
     deletion_id: str
-    submission: Submission = None
+    submission: Optional[SubmissionData] = None
+    # the event loop time of receiving
+    received_at: float = 0.0
 
 
 class TelemetryService:
     def __init__(
         self,
         queue_client: QueueClient,
-        event_streamer: EventStreamer
+        event_streamer: EventStreamer,
+        acknowledger: AckCoalescer,
+        completed_submissions: CompletedSubmissionCache,
+        visibility_tracker: Optional[VisibilityTracker] = None,
     ):
         self.queue_client = queue_client
         self.event_streamer = event_streamer
+        self.acknowledger = acknowledger
+        self.completed_submissions = completed_submissions
+        self.visibility_tracker = visibility_tracker
 
-    def get_messages(self) -> Tuple[List[Message], List[Message]]:
+    async def receive_messages(self) -> List[Mapping[str, Any]]:
         try:
-            messages = self.queue_client.get_messages()
+            messages = await self.queue_client.get_messages()
         except QueueClientException as ex:
             raise SubmissionReceivingError from ex
+        messages = list(messages)
+        if self.visibility_tracker is not None:
+            self.visibility_tracker.track(self.queue_client.get_deletion_id(m) for m in messages)
+        return messages
 
-        valid_submissions, invalid_submissions = self.parse_messages(messages)
-        return valid_submissions, invalid_submissions
+    def get_pollers(self) -> Optional[int]:
+        return self.queue_client.get_pollers()
 
     def parse_messages(self, messages: Iterable[Mapping[str, Any]]) -> Tuple[List[Message], List[Message]]:
         valid_messages, invalid_messages = [], []
+        bodies, parsed_messages = [], []
         for message in messages:
             deletion_id = self.queue_client.get_deletion_id(message)
             try:
@@ -48,39 +65,91 @@ class TelemetryService:
                 continue
 
             try:
-                raw_submission = self.queue_client.get_submission_from_message(
-                    message
-                )
+                body = self.queue_client.get_submission_body(message)
             except QueueClientUnexpectedMessage:
                 invalid_messages.append(parsed_message)
                 continue
+            bodies.append(body)
+            parsed_messages.append(parsed_message)
 
-            try:
-                submission = Submission(**raw_submission)
-            except pydantic.ValidationError as ex:
-                logger.warning(
-                    f"can not retrieve a submission from the message: {ex}. "
-                    f"Message: {message}. "
-                    f"Submission: {raw_submission}"
-                )
+        submissions = validate_submissions(bodies)
+        for parsed_message, submission in zip(parsed_messages, submissions):
+            if submission is None:
                 invalid_messages.append(parsed_message)
                 continue
-
             parsed_message.submission = submission
             valid_messages.append(parsed_message)
 
         return valid_messages, invalid_messages
 
-    async def process_invalid_message(self, message: Message):
-        logger.debug(f"process invalid submission: {message}")
-        await self.queue_client.delete_message(message.deletion_id)
+    async def publish_messages(self, messages: List[Message]) -> List[Optional[bool]]:
+        logger.debug(f"process valid messages: {messages}")
+        results = [
+            message.submission["submission_id"] in self.completed_submissions
+            for message in messages
+        ]
+        new_indexes = [i for i, is_completed in enumerate(results) if not is_completed]
+        if len(new_indexes) < len(messages):
+            logger.debug(f"skip {len(messages) - len(new_indexes)} completed submissions")
+        if not new_indexes:
+            return results
 
-    async def process_valid_message(self, message: Message):
-        logger.debug(f"process valid message: {message}")
         try:
-            success = await self.event_streamer.downstream_submission(message.submission)
+            new_results = await self.event_streamer.downstream_submissions(
+                [messages[i].submission for i in new_indexes]
+            )
         except EventStreamerException as ex:
             raise ex
 
-        if success:
-            await self.queue_client.delete_message(message.deletion_id)
+        for i, success in zip(new_indexes, new_results):
+            results[i] = success
+            if success:
+                self.completed_submissions.add(messages[i].submission["submission_id"])
+        return results
+
+    async def acknowledge(self, message: Message):
+        logger.debug(f"acknowledge the message: {message.deletion_id}")
+        try:
+            await self.acknowledger.ack(message.deletion_id)
+        finally:
+            if self.visibility_tracker is not None:
+                self.visibility_tracker.untrack(message.deletion_id)
+
+    def release(self, messages: List[Message]):
+        """
+        Makes failed messages visible at once, so they are retried without
+        waiting for the visibility timeout.
+        """
+        logger.debug(f"release the messages: {[m.deletion_id for m in messages]}")
+        if self.visibility_tracker is not None:
+            self.visibility_tracker.release(m.deletion_id for m in messages)
+
+    async def release_unstarted(
+        self, messages: List[Message], received: Iterable[Mapping[str, Any]] = ()
+    ) -> int:
+        """
+        Makes the parsed and received messages that were not processed visible
+        at once, e.g. on shutdown. Returns the number of released messages.
+        """
+        deletion_ids = [message.deletion_id for message in messages]
+        deletion_ids.extend(self.queue_client.get_deletion_id(message) for message in received)
+        if not deletion_ids:
+            return 0
+        if self.visibility_tracker is not None:
+            for deletion_id in deletion_ids:
+                self.visibility_tracker.untrack(deletion_id)
+        try:
+            failed = await self.queue_client.change_visibility(deletion_ids, 0)
+        except QueueClientException:
+            logger.warning(f"can not release {len(deletion_ids)} unstarted messages")
+            return 0
+        return len(deletion_ids) - len(failed)
+
+    def postpone(self, messages: List[Message]):
+        """
+        Stops extending the visibility of messages that can not be processed
+        now, so they are redelivered after the visibility timeout.
+        """
+        if self.visibility_tracker is not None:
+            for message in messages:
+                self.visibility_tracker.untrack(message.deletion_id)
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import logging.config
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from app.metrics import MetricsSnapshot, merge_snapshots, registry
+from app.settings import get_settings
+from app.worker.infrastructure.clients.sqs import check_receive_options
+from app.worker.tuning import ParametersUnavailableError, PipelineParameters, PipelineParametersUpdate
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 1
+
+
+@dataclass
+class _WorkerProcess:
+    index: int
+    process: multiprocessing.Process
+    started_at: float
+    heartbeat_at: float
+    # parameter changes for the process
+    commands: multiprocessing.Queue
+    status: bool = False
+    parameters: Optional[Dict[str, Any]] = None
+    metrics: MetricsSnapshot = field(default_factory=dict)
+    slow_submissions: List[Dict[str, Any]] = field(default_factory=list)
+
+
+class WorkerSupervisor:
+    """
+    Runs workers in child processes to use all cores of a node.
+
+    Every child has its own pollers, AWS clients and a database pool.
+    Children report their status and metrics with heartbeats, and the
+    supervisor restarts a child that exits or stops sending heartbeats.
+    Parameter changes are sent to every child and to the restarted ones.
+    """
+    def __init__(
+        self,
+        processes: int,
+        heartbeat_timeout: float,
+        restart_timeout: float,
+        shutdown_timeout: float,
+        slow_submissions_log_size: int = 50,
+    ):
+        self.slow_submissions_log_size = slow_submissions_log_size
+        self.processes = processes or os.cpu_count()
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_timeout = restart_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._heartbeats = self._context.Queue()
+        self._stop_event = self._context.Event()
+        self._children: Dict[int, _WorkerProcess] = {}
+        self._parameter_changes: Dict[str, Any] = {}
+        self._running = False
+        self._restarts = registry.counter(
+            "worker_process_restarts_total", "Restarts of worker processes"
+        )
+
+    @property
+    def status(self) -> bool:
+        if not self._running or len(self._children) < self.processes:
+            return False
+        now = time.monotonic()
+        return all(
+            child.process.is_alive()
+            and child.status
+            and now - child.heartbeat_at < self.heartbeat_timeout
+            for child in self._children.values()
+        )
+
+    def stop(self):
+        self._running = False
+        self._stop_event.set()
+
+    def collect_metrics(self) -> MetricsSnapshot:
+        return merge_snapshots(
+            [registry.snapshot(), *[child.metrics for child in self._children.values()]]
+        )
+
+    def collect_slow_submissions(self) -> List[Dict[str, Any]]:
+        slow_submissions = [
+            trace for child in self._children.values() for trace in child.slow_submissions
+        ]
+        slow_submissions.sort(key=lambda trace: trace["duration"], reverse=True)
+        return slow_submissions[:self.slow_submissions_log_size]
+
+    def get_parameters(self) -> PipelineParameters:
+        """
+        Returns the parameters of a worker process. The pool sizes
+        are the bounds of the pool of every process.
+        """
+        for child in self._children.values():
+            if child.parameters is not None:
+                return PipelineParameters.model_validate(child.parameters)
+        raise ParametersUnavailableError("No worker process has reported its parameters yet")
+
+    async def update_parameters(self, changes: PipelineParametersUpdate) -> PipelineParameters:
+        parameters = self.get_parameters().update(changes)
+        # the worker processes receive from SQS, the file source runs in one process
+        check_receive_options(parameters.max_message_number_by_request, parameters.message_wait_time)
+        self._parameter_changes.update(changes.model_dump(exclude_none=True))
+        for child in self._children.values():
+            child.commands.put(changes.model_dump(exclude_none=True))
+        return parameters
+
+    async def run(self):
+        self._running = True
+        for index in range(self.processes):
+            self._start(index)
+        try:
+            while self._running:
+                self._receive_heartbeats()
+                await self._restart_failed()
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+        finally:
+            self._running = False
+            self._stop_event.set()
+            await asyncio.to_thread(self._shutdown)
+
+    def _start(self, index: int):
+        commands = self._context.Queue()
+        process = self._context.Process(
+            target=run_worker_process,
+            args=(index, self._heartbeats, self._stop_event, commands, dict(self._parameter_changes)),
+            name=f"telemetry-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        now = time.monotonic()
+        self._children[index] = _WorkerProcess(index, process, now, now, commands)
+        logger.info(f"started the worker process {index}: pid {process.pid}")
+
+    def _receive_heartbeats(self):
+        while True:
+            try:
+                index, pid, status, metrics, slow_submissions, parameters = self._heartbeats.get_nowait()
+            except queue.Empty:
+                return
+            child = self._children.get(index)
+            if child is None or child.process.pid != pid:
+                continue
+            child.heartbeat_at = time.monotonic()
+            child.status = status
+            child.metrics = metrics
+            child.slow_submissions = slow_submissions
+            child.parameters = parameters
+
+    async def _restart_failed(self):
+        now = time.monotonic()
+        for index, child in list(self._children.items()):
+            if child.process.is_alive():
+                if now - child.heartbeat_at < self.heartbeat_timeout:
+                    continue
+                logger.warning(f"the worker process {index} does not send heartbeats: terminate it")
+                child.process.terminate()
+                await asyncio.to_thread(child.process.join, self.shutdown_timeout)
+            else:
+                logger.warning(
+                    f"the worker process {index} exited with the code {child.process.exitcode}"
+                )
+            if now - child.started_at < self.restart_timeout:
+                # avoid a restart loop when a child fails on startup
+                await asyncio.sleep(self.restart_timeout)
+            if not self._running:
+                return
+            self._restarts.inc()
+            self._start(index)
+
+    def _shutdown(self):
+        deadline = time.monotonic() + self.shutdown_timeout
+        for child in self._children.values():
+            child.process.join(max(deadline - time.monotonic(), 0))
+        for child in self._children.values():
+            if child.process.is_alive():
+                logger.warning(f"the worker process {child.index} is still running: kill it")
+                child.process.kill()
+                child.process.join()
+
+
+def run_worker_process(
+    index: int,
+    heartbeats: multiprocessing.Queue,
+    stop_event,
+    commands: multiprocessing.Queue,
+    parameter_changes: Dict[str, Any],
+):
+    # the supervisor coordinates the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+    settings = get_settings()
+    if settings.debug:
+        logging.getLogger("app").setLevel(logging.DEBUG)
+    asyncio.run(_run_worker_process(index, heartbeats, stop_event, commands, parameter_changes))
+
+
+async def _run_worker_process(
+    index: int,
+    heartbeats: multiprocessing.Queue,
+    stop_event,
+    commands: multiprocessing.Queue,
+    parameter_changes: Dict[str, Any],
+):
+    from app.worker.bootstrap import create_worker
+
+    async with create_worker(get_settings()) as worker:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, worker.stop)
+        if parameter_changes:
+            await _update_parameters(worker, parameter_changes)
+        reporter = asyncio.create_task(_send_heartbeats(index, heartbeats, stop_event, commands, worker))
+        try:
+            await worker.run()
+        finally:
+            reporter.cancel()
+    logger.info(f"the worker process {index} is stopped")
+
+
+async def _send_heartbeats(
+    index: int, heartbeats: multiprocessing.Queue, stop_event, commands: multiprocessing.Queue, worker
+):
+    pid = os.getpid()
+    while True:
+        if stop_event.is_set():
+            worker.stop()
+        while True:
+            try:
+                changes = commands.get_nowait()
+            except queue.Empty:
+                break
+            await _update_parameters(worker, changes)
+        try:
+            parameters = worker.get_parameters().model_dump()
+        except Exception as ex:
+            logger.warning(f"can not get the pipeline parameters: {ex}")
+            parameters = None
+        heartbeats.put((
+            index,
+            pid,
+            worker.status,
+            registry.snapshot(),
+            worker.collect_slow_submissions(),
+            parameters,
+        ))
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+async def _update_parameters(worker, changes: Dict[str, Any]):
+    try:
+        await worker.update_parameters(PipelineParametersUpdate.model_validate(changes))
+    except ValueError as ex:
+        logger.warning(f"can not change the pipeline parameters: {ex}")
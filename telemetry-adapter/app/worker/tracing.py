@@ -0,0 +1,90 @@
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from uuid import UUID
+
+# traces of the submissions being published, by their IDs
+_current_traces: ContextVar[Optional[Mapping[UUID, "SubmissionTrace"]]] = ContextVar(
+    "current_traces", default=None
+)
+
+
+@dataclass
+class SubmissionTrace:
+    submission_id: UUID
+    # the event loop time of receiving
+    received_at: float
+    # the wall clock time of receiving, for humans
+    received_timestamp: float = field(default_factory=time.time)
+    stages: List[Tuple[str, float]] = field(default_factory=list)
+    duration: float = 0.0
+
+    def add_stage(self, stage: str, duration: float):
+        self.stages.append((stage, duration))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "submission_id": str(self.submission_id),
+            "received_at": self.received_timestamp,
+            "duration": self.duration,
+            "stages": [{"stage": stage, "duration": duration} for stage, duration in self.stages],
+        }
+
+
+def set_current_traces(traces: Mapping[UUID, SubmissionTrace]):
+    """
+    Makes the traces available to the code publishing the submissions
+    in the current task and the tasks it starts.
+    """
+    return _current_traces.set(traces)
+
+
+def reset_current_traces(token):
+    _current_traces.reset(token)
+
+
+def add_stage(submission_id: UUID, stage: str, duration: float):
+    traces = _current_traces.get()
+    if traces is None:
+        return
+    trace = traces.get(submission_id)
+    if trace is not None:
+        trace.add_stage(stage, duration)
+
+
+class SlowSubmissionsLog:
+    """
+    Keeps the `capacity` slowest submissions completed in the last
+    `window` seconds.
+    """
+    def __init__(self, capacity: int, window: float):
+        self.capacity = capacity
+        self.window = window
+        # a min-heap of (duration, order, completed at, trace)
+        self._traces: List[Tuple[float, int, float, SubmissionTrace]] = []
+        self._order = itertools.count()
+
+    def add(self, trace: SubmissionTrace):
+        now = time.monotonic()
+        self._expire(now)
+        entry = (trace.duration, next(self._order), now, trace)
+        if len(self._traces) < self.capacity:
+            heapq.heappush(self._traces, entry)
+        elif trace.duration > self._traces[0][0]:
+            heapq.heapreplace(self._traces, entry)
+
+    def get_slowest(self) -> List[Dict[str, Any]]:
+        self._expire(time.monotonic())
+        return [
+            trace.to_dict()
+            for _, _, _, trace in sorted(self._traces, key=lambda entry: entry[0], reverse=True)
+        ]
+
+    def _expire(self, now: float):
+        expired_at = now - self.window
+        if any(completed_at < expired_at for _, _, completed_at, _ in self._traces):
+            self._traces = [entry for entry in self._traces if entry[2] >= expired_at]
+            heapq.heapify(self._traces)
@@ -0,0 +1,82 @@
+import logging
+from typing import Optional
+
+from pydantic import BaseModel, ConfigDict, NonNegativeInt, PositiveInt, model_validator
+
+from app.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+parameter_changes = registry.counter(
+    "pipeline_parameter_changes_total", "Changes of pipeline parameters at runtime"
+)
+# the processes have the same parameters, so they are not added up
+parameter_values = registry.gauge("pipeline_parameter", "Current pipeline parameters", "max")
+
+
+class ParametersUnavailableError(Exception):
+    pass
+
+
+class PipelineParameters(BaseModel):
+    """
+    The parameters of a running pipeline that are changed without a restart,
+    named like the settings. The pool sizes are None without a database pool.
+    The receive options are checked against the limits of the source
+    (e.g. SQS) by its client.
+    """
+    max_message_number_by_request: PositiveInt
+    message_wait_time: NonNegativeInt
+    pollers: PositiveInt
+    publishers: PositiveInt
+    max_in_flight_submissions: PositiveInt
+    publish_batch_size: PositiveInt
+    min_pool_size: Optional[NonNegativeInt] = None
+    max_pool_size: Optional[PositiveInt] = None
+
+    @model_validator(mode="after")
+    def check_pool_size(self):
+        if (
+            self.min_pool_size is not None
+            and self.max_pool_size is not None
+            and self.max_pool_size < self.min_pool_size
+        ):
+            raise ValueError("max_pool_size must not be less than min_pool_size")
+        return self
+
+    def update(self, changes: "PipelineParametersUpdate") -> "PipelineParameters":
+        """
+        Returns the validated parameters with the changes.
+        """
+        return PipelineParameters.model_validate(
+            {**self.model_dump(), **changes.model_dump(exclude_none=True)}
+        )
+
+
+class PipelineParametersUpdate(BaseModel):
+    """
+    Changes of pipeline parameters, the omitted ones are not changed.
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    max_message_number_by_request: Optional[PositiveInt] = None
+    message_wait_time: Optional[NonNegativeInt] = None
+    pollers: Optional[PositiveInt] = None
+    publishers: Optional[PositiveInt] = None
+    max_in_flight_submissions: Optional[PositiveInt] = None
+    publish_batch_size: Optional[PositiveInt] = None
+    min_pool_size: Optional[NonNegativeInt] = None
+    max_pool_size: Optional[PositiveInt] = None
+
+
+def export_parameters(parameters: PipelineParameters, previous: Optional[PipelineParameters] = None):
+    """
+    Sets the parameter gauges and counts and logs the changes from `previous`.
+    """
+    for name, value in parameters.model_dump().items():
+        if value is None:
+            continue
+        parameter_values.set(value, parameter=name)
+        if previous is not None and getattr(previous, name) != value:
+            parameter_changes.inc(parameter=name)
+            logger.info(f"the pipeline parameter {name} is changed: {getattr(previous, name)} -> {value}")
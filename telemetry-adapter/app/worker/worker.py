@@ -1,43 +1,347 @@
 import asyncio
 import logging
+import time
 import traceback
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
 
-from app.worker.services.exceptions import SubmissionReceivingError
-from app.worker.services.submission import TelemetryService
+from psycopg_pool import AsyncConnectionPool
+
+from app.metrics import MetricsSnapshot, registry
+from app.worker.prefetcher import MessagePrefetcher
+from app.worker.services.submission import Message, TelemetryService
+from app.worker.tracing import (
+    SlowSubmissionsLog, SubmissionTrace, reset_current_traces, set_current_traces
+)
+from app.worker.tuning import PipelineParameters, PipelineParametersUpdate, export_parameters
 
 logger = logging.getLogger(__name__)
 
+received_messages = registry.counter("messages_received_total", "Received messages")
+invalid_messages = registry.counter("messages_invalid_total", "Dropped invalid messages")
+published_submissions = registry.counter("submissions_published_total", "Published submissions")
+failed_submissions = registry.counter("submissions_failed_total", "Submissions that were not published")
+postponed_submissions = registry.counter(
+    "submissions_postponed_total", "Submissions processed by another worker or left for a later retry"
+)
+acknowledged_messages = registry.counter("messages_acknowledged_total", "Deleted messages")
+failed_acknowledgements = registry.counter("acknowledgements_failed_total", "Failed message deletions")
+in_flight_messages = registry.gauge("messages_in_flight", "Messages in the pipeline")
+stage_duration = registry.histogram(
+    "pipeline_stage_duration_seconds", "Processing of a batch (parse, publish) or a message (ack)"
+)
+submission_latency = registry.histogram(
+    "submission_latency_seconds", "Time from receiving a valid submission to its deletion"
+)
+drain_duration = registry.histogram("worker_drain_duration_seconds", "Drains of the pipeline on shutdown")
+drain_released_messages = registry.counter(
+    "worker_drain_released_messages_total", "Unstarted messages made visible on shutdown"
+)
+drain_in_flight_messages = registry.counter(
+    "worker_drain_in_flight_messages_total", "Messages in processing when a drain started"
+)
+drain_abandoned_messages = registry.counter(
+    "worker_drain_abandoned_messages_total", "Messages still in processing at the drain deadline"
+)
+
 
 class Worker:
-    def __init__(self, submission_service: TelemetryService):
+    """
+    Runs the pipeline: receive -> parse/validate -> publish -> acknowledge.
+
+    The stages are connected by bounded queues and the number of messages
+    in the pipeline is limited by `max_in_flight`, so a slow stage makes
+    the previous stages wait instead of receiving more messages.
+
+    A stopped worker drains the pipeline: it stops receiving, releases
+    the messages whose publishing has not started and waits up to
+    `drain_timeout` seconds for the other ones to be published and deleted.
+
+    `update_parameters` changes the receive options, the concurrency and
+    the database pool bounds of a running pipeline. The messages in
+    processing are not dropped: a removed poller or publisher exits after
+    its current batch, and a lower in-flight limit stops receiving until
+    enough messages are completed.
+    """
+    def __init__(
+        self,
+        submission_service: TelemetryService,
+        pollers: int,
+        publishers: int,
+        max_in_flight: int,
+        publish_batch_size: int,
+        prefetch_buffer_size: int,
+        queue_size: int,
+        max_message_age: float,
+        slow_submissions: Optional[SlowSubmissionsLog] = None,
+        drain_timeout: float = 20.0,
+        connection_pool: Optional[AsyncConnectionPool] = None,
+    ):
         self.status = False
         self.error_timeout = 2
         self.submission_service = submission_service
+        self.pollers = pollers
+        self.publishers = publishers
+        self.max_in_flight = max_in_flight
+        self.publish_batch_size = publish_batch_size
+        self.prefetch_buffer_size = prefetch_buffer_size
+        self.queue_size = queue_size
+        self.max_message_age = max_message_age
+        self.drain_timeout = drain_timeout
+        self.connection_pool = connection_pool
+        self._stopped = asyncio.Event()
+        self._in_flight_number = 0
+        self._has_capacity = asyncio.Event()
+        self._idle = asyncio.Event()
+        # messages of the current batch that are not queued for publishing yet
+        self._unqueued: Deque[Message] = deque()
+        self._prefetcher: Optional[MessagePrefetcher] = None
+        self._start_publisher: Optional[Callable[[int], asyncio.Task]] = None
+        self._publishers: Dict[int, asyncio.Task] = {}
+        self._acknowledgements: Set[asyncio.Task] = set()
+        self.slow_submissions = slow_submissions or SlowSubmissionsLog(50, 900)
+        # traces of published submissions by deletion IDs until their deletion
+        self._traces: Dict[str, SubmissionTrace] = {}
+
+    def stop(self):
+        self.status = False
+        self._stopped.set()
+
+    def collect_metrics(self) -> MetricsSnapshot:
+        return registry.snapshot()
+
+    def collect_slow_submissions(self) -> List[Dict[str, Any]]:
+        return self.slow_submissions.get_slowest()
+
+    def get_parameters(self) -> PipelineParameters:
+        max_message_number, wait_time = self.submission_service.queue_client.get_receive_options()
+        pool = self.connection_pool
+        return PipelineParameters(
+            max_message_number_by_request=max_message_number,
+            message_wait_time=wait_time,
+            pollers=self.pollers,
+            publishers=self.publishers,
+            max_in_flight_submissions=self.max_in_flight,
+            publish_batch_size=self.publish_batch_size,
+            min_pool_size=pool.min_size if pool is not None else None,
+            max_pool_size=pool.max_size if pool is not None else None,
+        )
+
+    async def update_parameters(self, changes: PipelineParametersUpdate) -> PipelineParameters:
+        previous = self.get_parameters()
+        parameters = previous.update(changes)
+        # the client checks the options first, nothing is changed if they are invalid
+        self.submission_service.queue_client.set_receive_options(
+            parameters.max_message_number_by_request, parameters.message_wait_time, parameters.pollers
+        )
+        self.pollers = parameters.pollers
+        if self._prefetcher is not None:
+            self._prefetcher.set_pollers(self.pollers)
+        self.publishers = parameters.publishers
+        if self._start_publisher is not None:
+            for index in range(self.publishers):
+                publisher = self._publishers.get(index)
+                if publisher is None or publisher.done():
+                    self._publishers[index] = self._start_publisher(index)
+        self.publish_batch_size = parameters.publish_batch_size
+        self.max_in_flight = parameters.max_in_flight_submissions
+        self._has_capacity.set()
+        if self.connection_pool is not None and parameters.min_pool_size is not None:
+            await self.connection_pool.resize(parameters.min_pool_size, parameters.max_pool_size)
+        parameters = self.get_parameters()
+        export_parameters(parameters, previous)
+        return parameters
 
     async def run(self):
         self.status = True
-        while self.status:
+        parsed: asyncio.Queue[Message] = asyncio.Queue(maxsize=self.queue_size)
+        acks: asyncio.Queue[Message] = asyncio.Queue(maxsize=self.queue_size)
+        prefetcher = MessagePrefetcher(
+            self.submission_service.receive_messages,
+            self.prefetch_buffer_size,
+            self.max_message_age,
+            self.error_timeout,
+            self.pollers,
+            self.submission_service.get_pollers,
+        )
+        try:
+            export_parameters(self.get_parameters())
+        except Exception as ex:
+            logger.warning(f"can not export the pipeline parameters: {ex}")
+        try:
+            async with prefetcher, asyncio.TaskGroup() as tg:
+                self._prefetcher = prefetcher
+                self._start_publisher = lambda index: tg.create_task(self._publish(index, parsed, acks))
+                parsing = tg.create_task(self._parse(prefetcher, parsed, acks))
+                self._publishers = {index: self._start_publisher(index) for index in range(self.publishers)}
+                acknowledging = tg.create_task(self._acknowledge(acks))
+                await self._stopped.wait()
+                await self._drain(prefetcher, parsing, parsed)
+                self._start_publisher = None
+                for stage in [*self._publishers.values(), acknowledging]:
+                    stage.cancel()
+        finally:
+            self._prefetcher = None
+            self._start_publisher = None
+            self.status = False
+
+    async def _parse(
+        self,
+        prefetcher: MessagePrefetcher,
+        parsed: asyncio.Queue,
+        acks: asyncio.Queue,
+    ):
+        while True:
+            received_at, messages = await prefetcher.get_batch()
+            started_at = time.perf_counter()
+            valid, invalid = self.submission_service.parse_messages(messages)
+            stage_duration.observe(time.perf_counter() - started_at, stage="parse")
+            received_messages.inc(len(messages))
+            invalid_messages.inc(len(invalid))
+            logger.debug(f"Received valid submissions: {valid}")
+            logger.debug(f'Received invalid submissions: {invalid}')
+            for message in valid:
+                message.received_at = received_at
+            # the whole batch is registered before the first wait, so a drain
+            # cancelling the parsing releases all of its unqueued messages
+            self._unqueued.extend(invalid)
+            self._unqueued.extend(valid)
+            for _ in invalid:
+                await self._enqueue(acks)
+            for _ in valid:
+                await self._enqueue(parsed)
+
+    async def _enqueue(self, queue: asyncio.Queue):
+        await self._acquire()
+        try:
+            await queue.put(self._unqueued[0])
+        except asyncio.CancelledError:
+            self._release()
+            raise
+        self._unqueued.popleft()
+
+    async def _drain(self, prefetcher: MessagePrefetcher, parsing: asyncio.Task, parsed: asyncio.Queue):
+        started_at = time.perf_counter()
+        in_flight = self._in_flight_number + len(self._unqueued)
+        drain_in_flight_messages.inc(in_flight)
+        received = [message for batch in await prefetcher.stop() for message in batch]
+        parsing.cancel()
+        await asyncio.gather(parsing, return_exceptions=True)
+        unstarted = list(self._unqueued)
+        self._unqueued.clear()
+        while not parsed.empty():
+            unstarted.append(parsed.get_nowait())
+            self._release()
+        released = await self.submission_service.release_unstarted(unstarted, received)
+        drain_released_messages.inc(released)
+
+        abandoned = 0
+        try:
+            async with asyncio.timeout(max(0.0, self.drain_timeout - (time.perf_counter() - started_at))):
+                while self._in_flight_number:
+                    self._idle.clear()
+                    await self._idle.wait()
+                # the deletions of the last messages are in flight
+                await asyncio.gather(*self._acknowledgements, return_exceptions=True)
+        except TimeoutError:
+            abandoned = self._in_flight_number
+            drain_abandoned_messages.inc(abandoned)
+        duration = time.perf_counter() - started_at
+        drain_duration.observe(duration)
+        logger.info(
+            f"drained the pipeline in {duration:.2f}s: {in_flight} messages in processing, "
+            f"{released} of {len(unstarted) + len(received)} unstarted messages released, "
+            f"{abandoned} messages abandoned"
+        )
+
+    async def _publish(self, index: int, parsed: asyncio.Queue, acks: asyncio.Queue):
+        # a removed publisher exits after its current batch
+        while index < self.publishers:
+            messages = [await parsed.get()]
+            while len(messages) < self.publish_batch_size and not parsed.empty():
+                messages.append(parsed.get_nowait())
+
+            now = asyncio.get_running_loop().time()
+            traces = {}
+            for message in messages:
+                trace = SubmissionTrace(message.submission["submission_id"], message.received_at)
+                trace.add_stage("wait", now - message.received_at)
+                traces[trace.submission_id] = trace
+            token = set_current_traces(traces)
+            started_at = time.perf_counter()
             try:
-                valid, invalid = self.submission_service.get_messages()
-                logger.debug(f"Received valid submissions: {valid}")
-                logger.debug(f'Received invalid submissions: {invalid}')
-            except SubmissionReceivingError:
-                logger.debug("can not receive submissions")
-                await asyncio.sleep(self.error_timeout)
-                continue
-
-            awaitables = [
-                *[self.submission_service.process_invalid_message(s) for s in invalid],
-                *[self.submission_service.process_valid_message(s) for s in valid]
-            ]
-            results = await asyncio.gather(*awaitables, return_exceptions=True)
-            for result in results:
-                if not isinstance(result, Exception):
-                    continue
-                exc_trace = "".join(traceback.format_tb(result.__traceback__))
-                logger.warning(f"a submission processing error: {exc_trace}: {result}")
-
-            await asyncio.sleep(self.error_timeout)
+                results = await self.submission_service.publish_messages(messages)
+                stage_duration.observe(time.perf_counter() - started_at, stage="publish")
+            except Exception as ex:
+                exc_trace = "".join(traceback.format_tb(ex.__traceback__))
+                logger.warning(f"a submission processing error: {exc_trace}: {ex}")
+                results = [False] * len(messages)
+            finally:
+                reset_current_traces(token)
+
+            failed, postponed = [], []
+            for message, success in zip(messages, results):
+                if success:
+                    published_submissions.inc()
+                    self._traces[message.deletion_id] = traces[message.submission["submission_id"]]
+                    await acks.put(message)
+                elif success is None:
+                    postponed_submissions.inc()
+                    postponed.append(message)
+                    self._release()
+                else:
+                    failed_submissions.inc()
+                    failed.append(message)
+                    self._release()
+            if failed:
+                self.submission_service.release(failed)
+            if postponed:
+                self.submission_service.postpone(postponed)
+
+    async def _acknowledge(self, acks: asyncio.Queue):
+        while True:
+            message = await acks.get()
+            task = asyncio.create_task(self._ack(message))
+            self._acknowledgements.add(task)
+            task.add_done_callback(self._acknowledgements.discard)
+
+    async def _ack(self, message: Message):
+        started_at = time.perf_counter()
+        try:
+            await self.submission_service.acknowledge(message)
+            acknowledged_messages.inc()
+            duration = time.perf_counter() - started_at
+            stage_duration.observe(duration, stage="ack")
+            if message.submission is not None:
+                latency = asyncio.get_running_loop().time() - message.received_at
+                submission_latency.observe(latency)
+                trace = self._traces.get(message.deletion_id)
+                if trace is not None:
+                    trace.add_stage("delete", duration)
+                    trace.duration = latency
+                    self.slow_submissions.add(trace)
+        except Exception as ex:
+            failed_acknowledgements.inc()
+            exc_trace = "".join(traceback.format_tb(ex.__traceback__))
+            logger.warning(f"a submission acknowledgement error: {exc_trace}: {ex}")
+        finally:
+            self._traces.pop(message.deletion_id, None)
+            self._release()
+
+    async def _acquire(self):
+        # the limit may be lowered at runtime below the current number
+        while self._in_flight_number >= self.max_in_flight:
+            self._has_capacity.clear()
+            await self._has_capacity.wait()
+        self._in_flight_number += 1
+        in_flight_messages.inc()
+
+    def _release(self):
+        self._in_flight_number -= 1
+        in_flight_messages.dec()
+        self._has_capacity.set()
+        if not self._in_flight_number:
+            self._idle.set()
 
 
 worker = None
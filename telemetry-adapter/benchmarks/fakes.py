@@ -0,0 +1,254 @@
+"""
+In-process stand-ins for SQS, Kinesis and the submission state store.
+
+The AWS fakes replace aiobotocore clients, so the real SQSClient and
+KinesisClient run on top of them. Every fake counts its calls and can add
+latency and inject errors.
+"""
+import asyncio
+import hashlib
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Mapping, Optional, Sequence, Tuple
+from uuid import UUID
+
+from botocore.exceptions import ClientError
+
+from app.worker.infrastructure.clients.exceptions import SubmissionStoreException
+from app.worker.infrastructure.clients.interfaces import (
+    Checkpoint, ClaimResult, SubmissionStateStore
+)
+
+
+@dataclass
+class FaultProfile:
+    # seconds per call
+    latency: float = 0.0
+    # the probability of a failed call
+    error_rate: float = 0.0
+
+    async def apply(self, operation: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise ClientError(
+                {"Error": {"Code": "InternalFailure", "Message": "injected"}}, operation
+            )
+
+
+class FakeSQS:
+    """
+    A queue with visibility timeouts. Records the time from receiving
+    a message to its deletion.
+    """
+    def __init__(self, messages: Sequence[Mapping[str, Any]], faults: FaultProfile):
+        self.faults = faults
+        self.calls: Dict[str, int] = {}
+        self._visible: Deque[Mapping[str, Any]] = deque(
+            {**message, "MessageId": str(i)} for i, message in enumerate(messages)
+        )
+        # {receipt handle: (message, visible at, received at)}
+        self._in_flight: Dict[str, Tuple[Mapping[str, Any], float, float]] = {}
+        self._receipts = 0
+        self.latencies: List[float] = []
+        self.deleted = 0
+        self.total = len(messages)
+
+    def _count(self, operation: str):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _restore_expired(self, now: float):
+        for receipt_handle, (message, visible_at, _) in list(self._in_flight.items()):
+            if visible_at <= now:
+                del self._in_flight[receipt_handle]
+                self._visible.append(message)
+
+    async def receive_message(self, QueueUrl, MaxNumberOfMessages, VisibilityTimeout, WaitTimeSeconds, **kwargs):
+        self._count("receive_message")
+        await self.faults.apply("ReceiveMessage")
+        now = time.monotonic()
+        self._restore_expired(now)
+        if not self._visible and WaitTimeSeconds:
+            # long polling returns early when nothing comes
+            await asyncio.sleep(min(WaitTimeSeconds, 0.05))
+        messages = []
+        while self._visible and len(messages) < MaxNumberOfMessages:
+            message = self._visible.popleft()
+            self._receipts += 1
+            receipt_handle = f"{message['MessageId']}#{self._receipts}"
+            self._in_flight[receipt_handle] = (message, now + VisibilityTimeout, now)
+            messages.append({**message, "ReceiptHandle": receipt_handle})
+        return {"Messages": messages}
+
+    async def delete_message_batch(self, QueueUrl, Entries):
+        self._count("delete_message_batch")
+        await self.faults.apply("DeleteMessageBatch")
+        now = time.monotonic()
+        failed = []
+        for entry in Entries:
+            in_flight = self._in_flight.pop(entry["ReceiptHandle"], None)
+            if in_flight is None:
+                failed.append({"Id": entry["Id"], "Code": "ReceiptHandleIsInvalid", "SenderFault": True})
+                continue
+            self.deleted += 1
+            self.latencies.append(now - in_flight[2])
+        return {"Successful": [], "Failed": failed}
+
+    async def change_message_visibility_batch(self, QueueUrl, Entries):
+        self._count("change_message_visibility_batch")
+        await self.faults.apply("ChangeMessageVisibilityBatch")
+        now = time.monotonic()
+        failed = []
+        for entry in Entries:
+            in_flight = self._in_flight.get(entry["ReceiptHandle"])
+            if in_flight is None:
+                failed.append({"Id": entry["Id"], "Code": "ReceiptHandleIsInvalid", "SenderFault": True})
+                continue
+            message, _, received_at = in_flight
+            self._in_flight[entry["ReceiptHandle"]] = (
+                message, now + entry["VisibilityTimeout"], received_at
+            )
+        return {"Successful": [], "Failed": failed}
+
+    async def get_queue_attributes(self, QueueUrl, AttributeNames):
+        self._count("get_queue_attributes")
+        return {"Attributes": {"ApproximateNumberOfMessages": str(len(self._visible))}}
+
+
+class FakeKinesis:
+    """
+    A stream of `shards` shards. A shard accepts `shard_rate` records per
+    second and throttles the other ones, like Kinesis does.
+    """
+    def __init__(self, faults: FaultProfile, shards: int = 1, shard_rate: Optional[float] = None):
+        self.faults = faults
+        self.shard_rate = shard_rate
+        self.calls: Dict[str, int] = {}
+        self.records = 0
+        self.throttled = 0
+        step = 2 ** 128 // shards
+        self.shards = [
+            {
+                "ShardId": f"shardId-{i:012d}",
+                "HashKeyRange": {
+                    "StartingHashKey": str(i * step),
+                    "EndingHashKey": str((i + 1) * step - 1 if i < shards - 1 else 2 ** 128 - 1),
+                },
+                "SequenceNumberRange": {"StartingSequenceNumber": "0"},
+            }
+            for i in range(shards)
+        ]
+        self._starting_hash_keys = [i * step for i in range(shards)]
+        # {shard index: (the current second, records in it)}
+        self._usage: Dict[int, Tuple[int, int]] = {}
+
+    def _count(self, operation: str):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _get_shard(self, partition_key: str) -> int:
+        hash_key = int.from_bytes(hashlib.md5(partition_key.encode()).digest(), "big")
+        shard = 0
+        while shard + 1 < len(self._starting_hash_keys) and self._starting_hash_keys[shard + 1] <= hash_key:
+            shard += 1
+        return shard
+
+    def _accept(self, shard: int) -> bool:
+        if self.shard_rate is None:
+            return True
+        second = int(time.monotonic())
+        current_second, records = self._usage.get(shard, (second, 0))
+        if current_second != second:
+            records = 0
+        if records >= self.shard_rate:
+            return False
+        self._usage[shard] = (second, records + 1)
+        return True
+
+    async def put_records(self, StreamName, Records):
+        self._count("put_records")
+        await self.faults.apply("PutRecords")
+        results = []
+        failed = 0
+        for record in Records:
+            shard = self._get_shard(record["PartitionKey"])
+            if not self._accept(shard):
+                self.throttled += 1
+                failed += 1
+                results.append({
+                    "ErrorCode": "ProvisionedThroughputExceededException",
+                    "ErrorMessage": "Rate exceeded for shard",
+                })
+                continue
+            self.records += 1
+            results.append({"SequenceNumber": str(self.records), "ShardId": self.shards[shard]["ShardId"]})
+        return {"FailedRecordCount": failed, "Records": results}
+
+    async def list_shards(self, **kwargs):
+        self._count("list_shards")
+        return {"Shards": self.shards}
+
+
+class InMemorySubmissionStore(SubmissionStateStore):
+    """
+    Keeps submission states in a dict with the semantics of
+    PostgresSubmissionStore, including leases and fencing tokens.
+    """
+    def __init__(self, faults: FaultProfile, lease_ttl: float = 5.0):
+        self.faults = faults
+        self.lease_ttl = lease_ttl
+        self.calls: Dict[str, int] = {}
+        # {submission ID: [status, delivered events, sequence number, lease expires at, fencing token]}
+        self._submissions: Dict[UUID, List[Any]] = {}
+        # {submission ID: fencing token} of the leased submissions
+        self._leases: Dict[UUID, int] = {}
+
+    def _count(self, operation: str):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    async def _apply_faults(self, operation: str):
+        try:
+            await self.faults.apply(operation)
+        except ClientError as ex:
+            raise SubmissionStoreException from ex
+
+    async def claim(self, submissions: Sequence[Tuple[UUID, int]]) -> List[ClaimResult]:
+        self._count("claim")
+        await self._apply_faults("claim")
+        now = time.monotonic()
+        results: List[ClaimResult] = []
+        for submission_id, event_number in submissions:
+            state = self._submissions.get(submission_id)
+            if state is None:
+                state = self._submissions[submission_id] = ["pending", 0, None, now + self.lease_ttl, 1]
+            elif state[0] == "processed" and state[1] >= event_number:
+                results.append((state[1], None, True))
+                continue
+            elif state[0] == "processed" or state[3] < now:
+                state[0], state[3], state[4] = "pending", now + self.lease_ttl, state[4] + 1
+            else:
+                results.append((0, None, False))
+                continue
+            self._leases[submission_id] = state[4]
+            results.append((state[1], state[2], None))
+        return results
+
+    async def save_checkpoints(self, checkpoints: Sequence[Checkpoint]):
+        self._count("save_checkpoints")
+        fencing_tokens = [self._leases.pop(submission_id, 0) for submission_id, _, _ in checkpoints]
+        await self._apply_faults("save_checkpoints")
+        for (submission_id, delivered, sequence_number), fencing_token in zip(checkpoints, fencing_tokens):
+            state = self._submissions[submission_id]
+            if state[4] == fencing_token:
+                state[:4] = ["processed", delivered, sequence_number, None]
+
+    def release_leases(self, submission_ids: Sequence[UUID]):
+        for submission_id in submission_ids:
+            self._leases.pop(submission_id, None)
+
+    def processed_submissions(self) -> int:
+        return sum(1 for state in self._submissions.values() if state[0] == "processed")
+
+    def delivered_events(self) -> int:
+        return sum(state[1] for state in self._submissions.values())
@@ -0,0 +1,179 @@
+"""
+Runs the worker pipeline against in-process SQS, Kinesis and submission
+store stand-ins and reports its throughput, the latency from receiving
+a message to its deletion, calls per submission and CPU time per event.
+
+The pipeline is configured by the environment (or .env) like the service,
+e.g. PUBLISHERS=4 KINESIS_AGGREGATION=true. The results are saved to
+benchmarks/results/<commit>.json to compare commits.
+
+Usage: python -m benchmarks.throughput [--messages 5000] [--kinesis-latency 0.02]
+    [--kinesis-shard-rate 1000] [--compare benchmarks/results/<commit>.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import time
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from app.settings import Settings
+from app.worker.bootstrap import build_worker, create_sqs_client
+from app.worker.infrastructure.clients.kinesis import KinesisClient
+from benchmarks.fakes import FakeKinesis, FakeSQS, FaultProfile, InMemorySubmissionStore
+from benchmarks.validation import generate_messages
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+# the settings the stand-ins do not use
+PLACEHOLDER_SETTINGS = {
+    "queue_url": "benchmark",
+    "endpoint_url": "",
+    "db_url": "",
+    "max_message_number_by_request": 10,
+    "sqs_visibility_timeout": 30,
+    "message_wait_time": 0,
+}
+
+
+def get_settings() -> Settings:
+    environment = {name.lower() for name in os.environ}
+    return Settings(**{
+        name: value for name, value in PLACEHOLDER_SETTINGS.items() if name not in environment
+    })
+
+
+def get_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        changes = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if changes else commit
+
+
+def percentile(values, q: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def run(args, settings: Settings) -> Dict[str, Any]:
+    messages = generate_messages(args.messages, args.invalid_probability)
+    sqs = FakeSQS(messages, FaultProfile(args.sqs_latency, args.sqs_error_rate))
+    kinesis = FakeKinesis(
+        FaultProfile(args.kinesis_latency, args.kinesis_error_rate),
+        args.kinesis_shards,
+        args.kinesis_shard_rate,
+    )
+    store = InMemorySubmissionStore(FaultProfile(args.db_latency, args.db_error_rate))
+
+    async with AsyncExitStack() as stack:
+        worker = await build_worker(
+            settings, stack, create_sqs_client(settings, sqs), KinesisClient(kinesis), store
+        )
+        started_at = time.perf_counter()
+        cpu_started_at = time.process_time()
+        worker_task = asyncio.create_task(worker.run())
+        deadline = started_at + args.timeout
+        while sqs.deleted < sqs.total and time.perf_counter() < deadline and not worker_task.done():
+            await asyncio.sleep(0.01)
+        duration = time.perf_counter() - started_at
+        cpu_time = time.process_time() - cpu_started_at
+        worker.stop()
+        await worker_task
+
+    submissions = store.processed_submissions()
+    events = store.delivered_events()
+    aws_calls = sum(sqs.calls.values()) + sum(kinesis.calls.values())
+    db_calls = sum(store.calls.values())
+    return {
+        "completed": sqs.deleted >= sqs.total,
+        "messages": sqs.total,
+        "deleted_messages": sqs.deleted,
+        "submissions": submissions,
+        "events": events,
+        "kinesis_records": kinesis.records,
+        "throttled_records": kinesis.throttled,
+        "duration_seconds": duration,
+        "submissions_per_second": submissions / duration,
+        "events_per_second": events / duration,
+        "latency_p50_seconds": percentile(sqs.latencies, 50),
+        "latency_p99_seconds": percentile(sqs.latencies, 99),
+        "db_calls_per_submission": db_calls / max(submissions, 1),
+        "aws_calls_per_submission": aws_calls / max(submissions, 1),
+        "cpu_us_per_event": cpu_time / max(events, 1) * 1e6,
+        "calls": {"sqs": sqs.calls, "kinesis": kinesis.calls, "db": store.calls},
+    }
+
+
+def compare(results: Dict[str, Any], baseline_path: Path):
+    baseline = json.loads(baseline_path.read_text())
+    print(f"compared with {baseline['commit']}:")
+    for name, value in results.items():
+        base = baseline["results"].get(name)
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and base:
+            print(f"{name:>28}: {base:12.4f} -> {value:12.4f} ({(value - base) / base:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--invalid-probability", type=float, default=0.01)
+    parser.add_argument("--sqs-latency", type=float, default=0.01)
+    parser.add_argument("--sqs-error-rate", type=float, default=0.0)
+    parser.add_argument("--kinesis-latency", type=float, default=0.02)
+    parser.add_argument("--kinesis-error-rate", type=float, default=0.0)
+    parser.add_argument("--kinesis-shards", type=int, default=4)
+    parser.add_argument(
+        "--kinesis-shard-rate", type=float, default=None,
+        help="records per second a shard accepts before throttling"
+    )
+    parser.add_argument("--db-latency", type=float, default=0.002)
+    parser.add_argument("--db-error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=300.0, help="stop a run after this time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=None, help="the default is results/<commit>.json")
+    parser.add_argument("--compare", type=Path, default=None, help="a result of another commit")
+    args = parser.parse_args()
+
+    # invalid submissions and injected errors are logged as warnings
+    logging.disable(logging.WARNING)
+    random.seed(args.seed)
+    settings = get_settings()
+    results = asyncio.run(run(args, settings))
+
+    commit = get_commit()
+    output: Optional[Path] = args.output or RESULTS_DIR / f"{commit}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        "commit": commit,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": {name: str(value) if isinstance(value, Path) else value for name, value in vars(args).items()},
+        "settings": settings.model_dump(mode="json", exclude={"queue_url", "endpoint_url", "db_url", "admin_token"}),
+        "results": results,
+    }, indent=2))
+
+    for name, value in results.items():
+        if isinstance(value, float):
+            print(f"{name:>28}: {value:12.4f}")
+        elif not isinstance(value, dict):
+            print(f"{name:>28}: {value!s:>12}")
+    print(f"saved to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Compares the decode-and-validate paths on sensor-fleet-shaped messages.
+
+Usage: python -m benchmarks.validation [--messages 10000] [--batch-size 10]
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import random
+import timeit
+import uuid
+from datetime import datetime
+
+import pydantic
+
+from app.worker.infrastructure.clients.exceptions import QueueClientUnexpectedMessage
+from app.worker.infrastructure.clients.sqs import SQSClient
+from app.worker.infrastructure.types import Submission
+from app.worker.infrastructure.validation import validate_submissions
+
+COMMANDS = ["whoami", "notepad.exe", "calculator.exe"]
+SOURCE_IPS = ["192.168.0.1", "192.168.0.2"]
+DESTINATION_IPS = ["142.250.74.110", "23.13.252.39"]
+USERS = ["admin", "evil-guy", "john"]
+
+
+def generate_submission(device_id, invalid_probability):
+    def valid():
+        return random.uniform(0, 1) > invalid_probability
+
+    return {
+        "submission_id": str(uuid.uuid4()) if valid() else "not-an-uuid",
+        "device_id": device_id if valid() else "not-an-uuid",
+        "time_created": datetime.now().isoformat(),
+        "events": {
+            "new_process": [
+                {"cmdl": random.choice(COMMANDS) if valid() else None, "user": random.choice(USERS)}
+                for _ in range(random.randint(3, 5))
+            ],
+            "network_connection": [
+                {
+                    "source_ip": random.choice(SOURCE_IPS),
+                    "destination_ip": random.choice(DESTINATION_IPS) if valid() else "not-an-ip",
+                    "destination_port": random.randint(0, 65535),
+                }
+                for _ in range(random.randint(3, 5))
+            ],
+        },
+    }
+
+
+def generate_messages(number, invalid_probability):
+    device_ids = [str(uuid.uuid4()) for _ in range(10)]
+    messages = []
+    for _ in range(number):
+        submission = generate_submission(random.choice(device_ids), invalid_probability)
+        body = base64.b64encode(json.dumps(submission).encode()).decode()
+        messages.append({
+            "ReceiptHandle": str(uuid.uuid4()),
+            "MD5OfBody": hashlib.md5(body.encode()).hexdigest(),
+            "Body": body,
+        })
+    return messages
+
+
+def validate_with_models(sqs_client, batch):
+    submissions = []
+    for message in batch:
+        try:
+            raw_submission = sqs_client.get_submission_from_message(message)
+            submissions.append(Submission(**raw_submission))
+        except (QueueClientUnexpectedMessage, pydantic.ValidationError):
+            submissions.append(None)
+    return submissions
+
+
+def validate_from_bytes(sqs_client, batch):
+    return validate_submissions([sqs_client.get_submission_body(message) for message in batch])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--invalid-probability", type=float, default=0.01)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # invalid submissions are logged as warnings
+    logging.disable(logging.WARNING)
+    random.seed(0)
+    sqs_client = SQSClient(None, "benchmark", 10, 10, 0)
+    messages = generate_messages(args.messages, args.invalid_probability)
+    batches = [
+        messages[i:i + args.batch_size] for i in range(0, len(messages), args.batch_size)
+    ]
+
+    model_results = [s is not None for b in batches for s in validate_with_models(sqs_client, b)]
+    fast_results = [s is not None for b in batches for s in validate_from_bytes(sqs_client, b)]
+    assert model_results == fast_results, "the paths disagree on valid submissions"
+
+    print(f"messages: {args.messages}, batch size: {args.batch_size}, "
+          f"valid: {sum(fast_results)}")
+    baseline = None
+    for name, validate in [
+        ("pydantic models", validate_with_models),
+        ("validation from bytes", validate_from_bytes),
+    ]:
+        seconds = min(timeit.repeat(
+            lambda: [validate(sqs_client, batch) for batch in batches],
+            number=1,
+            repeat=args.repeat,
+        ))
+        per_message = seconds / args.messages * 1e6
+        baseline = baseline or per_message
+        print(f"{name:>24}: {per_message:8.2f} us/message  x{baseline / per_message:.2f}")
+
+
+if __name__ == "__main__":
+    main()